@@ -0,0 +1,902 @@
+#!/usr/bin/python3
+#
+#-- openweather.py
+#
+#   Gets the weather from the OPEN Weather API (used by py-weather.py  and
+#   py-pygame-weather.py).
+#
+#   Requires:           python3 (uses python3-orjson or python3-ujson to
+#                       parse JSON if either is installed)
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under  the terms of the GNU General Public License as published by  the
+#   Free Software Foundation, either version 3 of the License, or (at  your
+#   option) any later version.
+#
+#   This  program is distributed in the hope that it will  be  useful,  but
+#   WITHOUT   ANY   WARRANTY;   without even  the   implied   warranty   of
+#   MERCHANTABILITY  or  FITNESS  FOR A PARTICULAR  PURPOSE.  See  the  GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   18 Oct 26   0.1   - Initial version, using the code to fetch and cache
+#                       the weather from py-weather.py and
+#                       py-pygame-weather.py - MT
+#                     - Requests  are sent using asyncio (so they  can  be
+#                       cancelled)  and each one times out separately - MT
+#                     - Returns  the status and error message  for  each
+#                       location  instead of writing them to  stderr  (or
+#                       exiting) - MT
+#                     - Records how long each stage of a request takes (DNS,
+#                       connect, TLS, first byte and parsing) which can be
+#                       summarized or served in Prometheus format - MT
+#                     - Can profile a run (using cProfile or by sampling
+#                       the stack of each thread) - MT
+#                     - Only loads the certificates used for TLS once - MT
+#                     - Can  build an index of the cities in the OpenWeather
+#                       bulk  city list (names sorted for prefix  searches
+#                       and a k-d tree for finding the nearest cities) that
+#                       is memory mapped when it is first used - MT
+#                     - Requests the weather using the city ID if there is
+#                       only one city with that name in the index (or the
+#                       location is a city ID such as '#2643743') - MT
+#                     - Only  extracts the elements that are needed  from
+#                       XML  responses  (using  expat  directly  instead of
+#                       xmltodict) and uses a faster JSON parser if one is
+#                       installed - MT
+#                     - Finds  when the weather was calculated without
+#                       parsing the whole response - MT
+#                     - Only imports asyncio when it is first used (so  it
+#                       doesn't slow down starting the display) - MT
+#
+# Example:
+#
+#   import openweather
+#   for _result in openweather.run(openweather.fetch_many(['London', 'Paris'], '<API_Key>')):
+#     print(_result.location, _result.status or _result.data['main']['temp'], _result.error)
+#
+VERSION = "0.1"
+
+JOBS = 8 # Maximum number of requests to send at the same time
+BACKLOG = 4 # Number of results to wait for (for each job) when they are needed in order
+REPEATS = 256 # Number of recent results kept for locations that are repeated
+TIMEOUT = 10 # Request timeout
+POOL_SIZE = 8 # Maximum number of idle connections to keep open
+RESPONSE_TTL = 600 # How long weather data remains current
+RESPONSE_KEEP = 86400 # How long to keep expired responses (which may still be valid)
+BURST_TIME = 12 # Requests that can be sent at once when limited (in seconds worth at the rate allowed)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Upper bounds of each histogram bucket (seconds)
+SAMPLE_INTERVAL = 0.005 # How often to sample the stack of each thread when profiling
+JSON_PARSERS = ('orjson', 'ujson', 'json') # Used in this order (if installed)
+
+import os, sys, time, threading, collections, bisect, heapq, socket, struct
+import urllib.parse, urllib.error
+
+API = 'https://api.openweathermap.org/data/2.5/'
+CACHE_FOLDER = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'py-weather')
+RESPONSE_CACHE = os.path.join(CACHE_FOLDER, 'responses.sqlite') # Cached responses from the server
+CITY_INDEX = os.path.join(CACHE_FOLDER, 'cities.index') # Index of the cities in the bulk city list
+CITY_LIST = 'https://bulk.openweathermap.org/sample/city.list.json.gz' # Bulk city list (used to build the index)
+
+
+def normalize(_location): # Ignore case and spaces so the same location is only fetched once
+  return ','.join([' '.join(_part.split()) for _part in _location.lower().split(',') if _part.strip()])
+
+def read(_filename): # Read locations (one per line) from a file or stdin
+  _file = sys.stdin if _filename == '-' else open(_filename, encoding = 'utf-8')
+  try:
+    for _line in _file:
+      _line = _line.strip()
+      if _line and _line[:1] != '#': # Ignore blank lines and comments
+        yield _line
+  finally:
+    if _file is not sys.stdin:
+      _file.close()
+
+def language(): # Get language from the locale
+  _locale = os.environ.get("LC_ALL") or os.environ.get("LANG") or os.environ.get("LC_CTYPE") or 'en'
+  return _locale.split('_')[0]
+
+def _canonical(_URI): # Remove the application ID (and sort the parameters) so the same request always has the same key
+  _parts = urllib.parse.urlsplit(_URI)
+  _query = sorted([(_name, _value) for (_name, _value) in urllib.parse.parse_qsl(_parts.query) if _name != 'appid'])
+  return urllib.parse.urlunsplit((_parts.scheme, _parts.netloc, _parts.path, urllib.parse.urlencode(_query), ''))
+
+def _timestamp(_data): # Time the weather data was calculated (earliest if there is more than one location)
+  import re
+  _times = re.findall(rb'"dt"\s*:\s*(\d+)', _data) # Much quicker than parsing the whole response
+  if _times:
+    return min([int(_time) for _time in _times])
+  _match = re.search(rb'<lastupdate value="([0-9T:-]+)"', _data) # XML
+  if _match:
+    import calendar
+    return calendar.timegm(time.strptime(_match.group(1).decode(), '%Y-%m-%dT%H:%M:%S'))
+  return None
+
+def _expires(_headers, _data): # Work out when a response should be fetched again
+  import re, email.utils
+  _now = time.time()
+  _expires = _now
+  _match = re.search(r'max-age=(\d+)', _headers.get('Cache-Control') or '')
+  if _match:
+    _expires = _now + int(_match.group(1))
+  elif _headers.get('Expires'):
+    try:
+      _expires = email.utils.parsedate_to_datetime(_headers.get('Expires')).timestamp()
+    except (TypeError, ValueError):
+      pass
+  _time = _timestamp(_data)
+  if _time: # The data isn't updated again until RESPONSE_TTL seconds after it was calculated
+    _expires = max(_expires, min(_time + RESPONSE_TTL, _now + RESPONSE_TTL))
+  return _expires
+
+def _retry_after(_headers): # How long the server asked us to wait (in seconds)
+  _value = (_headers and _headers.get('Retry-After')) or ''
+  if _value.strip().isdigit():
+    return int(_value)
+  try:
+    import email.utils
+    return max(0, email.utils.parsedate_to_datetime(_value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return 0
+
+
+class timings(object): # Histogram of how long each stage takes and counters (which can be exported in Prometheus format)
+
+  def __init__(self, _buckets = BUCKETS):
+    self.buckets = _buckets
+    self.stages = collections.OrderedDict() # Count in each bucket, total, count and maximum for each stage
+    self.counters = collections.OrderedDict()
+    self.sources = [] # Functions that return other values to export
+    self.lock = threading.Lock()
+
+  def observe(self, _name, _seconds):
+    with self.lock:
+      _stage = self.stages.get(_name)
+      if _stage is None:
+        _stage = self.stages[_name] = [[0] * (len(self.buckets) + 1), 0.0, 0, 0.0]
+      _stage[0][bisect.bisect_left(self.buckets, _seconds)] += 1
+      _stage[1] += _seconds
+      _stage[2] += 1
+      _stage[3] = max(_stage[3], _seconds)
+
+  def count(self, _name, _value = 1):
+    with self.lock:
+      self.counters[_name] = self.counters.get(_name, 0) + _value
+
+  def timer(self, _name): # Time a block of code ('with metrics.timer(name):')
+    _timings = self
+    class timer(object):
+      def __enter__(self):
+        self.start = time.perf_counter()
+      def __exit__(self, *_exception):
+        _timings.observe(_name, time.perf_counter() - self.start)
+    return timer()
+
+  def timed(self, _name): # Time each call to a function (decorator)
+    def _decorator(_function):
+      import functools
+      @functools.wraps(_function)
+      def _timed(*_args, **_kwargs):
+        _start = time.perf_counter()
+        try:
+          return _function(*_args, **_kwargs)
+        finally:
+          self.observe(_name, time.perf_counter() - _start)
+      return _timed
+    return _decorator
+
+  def add(self, _source): # Add a function that returns a dictionary of other values to export
+    self.sources.append(_source)
+
+  def quantile(self, _stage, _quantile): # Estimate a quantile from the buckets (like Prometheus)
+    (_counts, _total, _count, _max) = _stage
+    _rank = _quantile * _count
+    _seen = 0
+    for (_index, _bucket) in enumerate(_counts):
+      if _bucket and _seen + _bucket >= _rank:
+        _low = self.buckets[_index - 1] if _index else 0
+        _high = self.buckets[_index] if _index < len(self.buckets) else _max
+        return min(_max, _low + (_high - _low) * (_rank - _seen) / _bucket)
+      _seen += _bucket
+    return _max
+
+  def export(self, _prefix = 'py_weather_'): # Prometheus text format
+    with self.lock:
+      _stages = [(_name, [list(_stage[0])] + _stage[1:]) for (_name, _stage) in self.stages.items()]
+      _counters = list(self.counters.items())
+    for _source in self.sources:
+      _counters += list(_source().items())
+    _output = []
+    if _stages:
+      _output.append('# TYPE ' + _prefix + 'stage_seconds histogram\n')
+    for (_name, (_counts, _total, _count, _max)) in _stages:
+      _cumulative = 0
+      for (_bound, _bucket) in zip([repr(float(_bound)) for _bound in self.buckets] + ['+Inf'], _counts):
+        _cumulative += _bucket
+        _output.append(_prefix + 'stage_seconds_bucket{stage="' + _name + '",le="' + _bound + '"} ' + str(_cumulative) + '\n')
+      _output.append(_prefix + 'stage_seconds_sum{stage="' + _name + '"} ' + repr(_total) + '\n')
+      _output.append(_prefix + 'stage_seconds_count{stage="' + _name + '"} ' + str(_count) + '\n')
+    for (_name, _value) in _counters:
+      _output.append('# TYPE ' + _prefix + _name + (' counter\n' if _name.endswith('_total') else ' gauge\n'))
+      _output.append(_prefix + _name + ' ' + str(_value) + '\n')
+    return ''.join(_output)
+
+  def serve(self, _port, _address = '127.0.0.1'): # Serve the metrics over HTTP (in the background)
+    import http.server
+    _timings = self
+    class handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+          self.send_error(404)
+          return
+        _data = _timings.export().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(_data)))
+        self.end_headers()
+        self.wfile.write(_data)
+      def log_message(self, *_args): # Don't log each request
+        pass
+    _server = http.server.ThreadingHTTPServer((_address, _port), handler)
+    _server.daemon_threads = True
+    threading.Thread(target = _server.serve_forever, daemon = True).start()
+    return _server
+
+  def summary(self):
+    with self.lock:
+      _stages = [(_name, [list(_stage[0])] + _stage[1:]) for (_name, _stage) in self.stages.items()]
+    if not _stages:
+      return ''
+    _output = ['Stage            Count  Mean (ms)   p50 (ms)   p99 (ms)   Max (ms)\n']
+    for (_name, _stage) in _stages:
+      _output.append(_name.ljust(12) + '%9d' % _stage[2] + '%11.2f' % (_stage[1] / _stage[2] * 1000) +
+                     '%11.2f' % (self.quantile(_stage, 0.5) * 1000) + '%11.2f' % (self.quantile(_stage, 0.99) * 1000) +
+                     '%11.2f' % (_stage[3] * 1000) + '\n')
+    return ''.join(_output)
+
+metrics = timings()
+
+
+class profiler(object): # Profiles a run using cProfile (if the file name ends in '.prof') or by sampling the stack of every thread
+
+  def __init__(self, _filename, _interval = SAMPLE_INTERVAL):
+    self.filename = _filename
+    self.interval = _interval
+    self.sampled = not _filename.endswith('.prof')
+    self.stacks = collections.Counter() # Number of times each stack was seen
+    self.running = False
+
+  def start(self):
+    self.running = True
+    if self.sampled:
+      self.thread = threading.Thread(target = self.sample, daemon = True)
+      self.thread.start()
+    else:
+      import cProfile
+      self.profile = cProfile.Profile() # Only profiles the main thread
+      self.profile.enable()
+
+  def sample(self): # Count the stack of each thread (except this one) until stopped
+    _self = threading.get_ident()
+    while self.running:
+      for (_thread, _frame) in sys._current_frames().items():
+        if _thread != _self:
+          _stack = []
+          while _frame is not None:
+            _stack.append(os.path.basename(_frame.f_code.co_filename) + ':' + _frame.f_code.co_name)
+            _frame = _frame.f_back
+          self.stacks[';'.join(reversed(_stack))] += 1
+      time.sleep(self.interval)
+
+  def stop(self): # Write the profile (sampled stacks are written in the 'collapsed' format used to draw flame graphs)
+    if not self.running:
+      return
+    self.running = False
+    if self.sampled:
+      self.thread.join()
+      with open(self.filename, 'w') as _file:
+        for (_stack, _count) in self.stacks.most_common():
+          _file.write(_stack + ' ' + str(_count) + '\n')
+    else:
+      self.profile.disable()
+      self.profile.dump_stats(self.filename) # Can be read using pstats
+
+
+class bucket(object): # Limits the number of requests sent each minute (token bucket)
+
+  def __init__(self, _rate = None, _size = None): # Not limited unless a rate is given
+    self.time = time.time()
+    self.until = 0 # Don't send any requests until this time
+    self.lock = threading.Lock() # Shared by every thread (and event loop)
+    self.waits = 0
+    self.set(_rate, _size)
+
+  def set(self, _rate, _size = None): # Change the number of requests each minute (None for no limit) and the burst size
+    with self.lock:
+      self.rate = _rate / 60 if _rate else None # Tokens added each second
+      self.size = _size or max(1, int((_rate or 0) * BURST_TIME / 60)) # Burst grows with the rate unless given
+      self.tokens = self.size
+
+  async def take(self): # Wait for a token
+    import asyncio
+    while True:
+      with self.lock:
+        _now = time.time()
+        if self.rate is None: # Only waits if the server is busy
+          if _now >= self.until:
+            return
+          _delay = self.until - _now
+        else:
+          self.tokens = min(self.size, self.tokens + (_now - self.time) * self.rate)
+          self.time = _now
+          if _now >= self.until and self.tokens >= 1:
+            self.tokens -= 1
+            return
+          _delay = max(self.until - _now, (1 - self.tokens) / self.rate)
+        self.waits += 1
+      await asyncio.sleep(_delay)
+
+  def pause(self, _seconds): # Stop sending requests for a while
+    with self.lock:
+      self.until = max(self.until, time.time() + _seconds)
+
+  def stats(self):
+    return ('Rate limit : \t\t' + (str(int(self.rate * 60)) + '/min' if self.rate else 'None') + ' (Waits: ' + str(self.waits) + ')\n')
+
+limit = bucket()
+
+
+class headers(dict): # Response headers (names are not case sensitive)
+
+  def get(self, _name, _default = None):
+    return dict.get(self, _name.lower(), _default)
+
+
+class connections(object): # Pool of persistent connections to the server (for each event loop)
+
+  def __init__(self, _size = POOL_SIZE):
+    self.size = _size
+    self.idle = {} # Connections that are not in use for each event loop and server
+    self.lock = threading.Lock()
+    self.opened = 0
+    self.reused = 0
+    self.reconnected = 0
+    self.context = None # Used for TLS
+
+  async def acquire(self, _scheme, _host):
+    import asyncio
+    _key = (asyncio.get_running_loop(), _scheme, _host)
+    with self.lock:
+      if self.idle.get(_key):
+        self.reused += 1
+        return self.idle[_key].pop() + (True,)
+      self.opened += 1
+    _parts = urllib.parse.urlsplit('//' + _host)
+    _port = _parts.port or (443 if _scheme == 'https' else 80)
+    with metrics.timer('dns'):
+      _addresses = await asyncio.get_running_loop().getaddrinfo(_parts.hostname, _port, type = socket.SOCK_STREAM)
+    _failure = OSError('Address not found (' + _host + ')')
+    _secure = {}
+    if _scheme == 'https':
+      if self.context is None:
+        import ssl
+        self.context = ssl.create_default_context()
+      _secure = {'ssl': self.context, 'server_hostname': _parts.hostname} # (StreamWriter.start_tls() needs Python 3.11)
+    with metrics.timer('tls' if _secure else 'connect'): # Includes the handshake for TLS
+      for (_family, _type, _protocol, _name, _address) in _addresses: # Try each address in turn
+        try:
+          (_reader, _writer) = await asyncio.open_connection(_address[0], _address[1], **_secure)
+          break
+        except OSError as _Error:
+          _failure = _Error
+      else:
+        raise _failure
+    return _reader, _writer, False
+
+  def release(self, _scheme, _host, _connection):
+    import asyncio
+    with self.lock:
+      _idle = self.idle.setdefault((asyncio.get_running_loop(), _scheme, _host), [])
+      if len(_idle) < self.size:
+        _idle.append(_connection)
+        return
+    _connection[1].close()
+
+  def close(self): # Close the idle connections used by the current event loop (before it is closed)
+    import asyncio
+    _loop = asyncio.get_running_loop()
+    with self.lock:
+      for _key in [_key for _key in self.idle if _key[0] is _loop]:
+        for (_reader, _writer) in self.idle.pop(_key):
+          _writer.close()
+
+  async def response(self, _reader): # Read the status, headers and data
+    _start = time.perf_counter()
+    _line = await _reader.readline()
+    metrics.observe('first_byte', time.perf_counter() - _start)
+    if not _line:
+      raise ConnectionResetError('Connection closed by server')
+    (_version, _status, _reason) = (_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    _status = int(_status)
+    _headers = headers()
+    while True:
+      _line = (await _reader.readline()).decode('latin-1').rstrip('\r\n')
+      if not _line:
+        break
+      (_name, _value) = _line.split(':', 1)
+      _headers[_name.strip().lower()] = _value.strip()
+    _close = _headers.get('Connection', '').lower() == 'close' or _version == 'HTTP/1.0'
+    if _status in [204, 304] or _status < 200: # No data
+      _data = b''
+    elif _headers.get('Transfer-Encoding', '').lower() == 'chunked':
+      _chunks = []
+      while True:
+        _size = int((await _reader.readline()).split(b';')[0], 16)
+        if not _size: # Last chunk is followed by any trailers and a blank line (not CRLF)
+          break
+        _chunks.append((await _reader.readexactly(_size + 2))[:-2]) # Includes CRLF after each chunk
+      while (await _reader.readline()).strip(): # Skip any trailers up to the blank line
+        pass
+      _data = b''.join(_chunks)
+    elif _headers.get('Content-Length') is not None:
+      _data = await _reader.readexactly(int(_headers.get('Content-Length')))
+    else: # Data ends when the connection is closed
+      _data = await _reader.read()
+      _close = True
+    return _status, _reason, _headers, _data, _close
+
+  async def send(self, _parts, _request): # Send request (reconnecting if an idle connection has been closed) and read the response
+    import asyncio
+    while True:
+      (_reader, _writer, _reused) = await self.acquire(_parts.scheme, _parts.netloc)
+      try:
+        _writer.write(_request)
+        await _writer.drain()
+        (_status, _reason, _response, _data, _close) = await self.response(_reader)
+        break
+      except (ConnectionError, asyncio.IncompleteReadError, ValueError) as _Error:
+        _writer.close()
+        if not _reused: # Only try again if the server closed a connection that was idle
+          raise urllib.error.URLError(_Error)
+        with self.lock:
+          self.reconnected += 1
+      except BaseException: # Including timeouts and cancellation
+        _writer.close()
+        raise
+    if _close:
+      _writer.close()
+    else:
+      self.release(_parts.scheme, _parts.netloc, (_reader, _writer))
+    return _status, _reason, _response, _data
+
+  async def get(self, _URI, _headers = {}, _timeout = TIMEOUT): # Send request and return the headers and data
+    import asyncio
+    _parts = urllib.parse.urlsplit(_URI)
+    _path = (_parts.path or '/') + ('?' + _parts.query if _parts.query else '')
+    _headers = dict(_headers, **{'Host': _parts.netloc, 'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'})
+    _request = ('GET ' + _path + ' HTTP/1.1\r\n' + ''.join([_name + ': ' + _value + '\r\n' for (_name, _value) in _headers.items()]) + '\r\n').encode('latin-1')
+    await limit.take() # Waiting for the rate limit doesn't count towards the timeout
+    metrics.count('requests_total')
+    with metrics.timer('request'):
+      (_status, _reason, _response, _data) = await asyncio.wait_for(self.send(_parts, _request), _timeout)
+    if _response.get('Content-Encoding') == 'gzip':
+      import gzip
+      _data = gzip.decompress(_data)
+    if _status in [429, 503] and _retry_after(_response):
+      limit.pause(_retry_after(_response)) # Server is busy
+    if _status >= 300:
+      raise urllib.error.HTTPError(_URI, _status, _reason, _response, None)
+    return _response, _data
+
+  def stats(self):
+    return ('Connections : \t\t' + 'Opened: ' + str(self.opened) + '  Reused: ' + str(self.reused) +
+            '  Reconnected: ' + str(self.reconnected) + '\n')
+
+pool = connections()
+
+
+class responses(object): # Cache of responses that is shared with other processes
+
+  def __init__(self, _path = RESPONSE_CACHE):
+    self.path = _path
+    self.enabled = True
+    self.hits = 0
+    self.misses = 0
+    self.revalidated = 0
+
+  def connect(self):
+    import sqlite3
+    os.makedirs(os.path.dirname(self.path), exist_ok = True)
+    _connection = sqlite3.connect(self.path, timeout = 30) # Wait for any other process to finish writing
+    _connection.execute('PRAGMA journal_mode=WAL') # Readers don't have to wait for writers
+    _connection.execute('CREATE TABLE IF NOT EXISTS responses (uri TEXT PRIMARY KEY, expires REAL, etag TEXT, modified TEXT, data BLOB)')
+    return _connection
+
+  def get(self, _key):
+    import sqlite3
+    try:
+      _connection = self.connect()
+      try:
+        return _connection.execute('SELECT expires, etag, modified, data FROM responses WHERE uri = ?', (_key,)).fetchone()
+      finally:
+        _connection.close()
+    except (OSError, sqlite3.Error): # Just fetch it if the cache can't be used
+      return None
+
+  def put(self, _key, _expires, _etag, _modified, _data):
+    import sqlite3
+    try:
+      _connection = self.connect()
+      try:
+        with _connection: # Commit changes
+          _connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (_key, _expires, _etag, _modified, _data))
+          _connection.execute('DELETE FROM responses WHERE expires < ?', (time.time() - RESPONSE_KEEP,))
+      finally:
+        _connection.close()
+    except (OSError, sqlite3.Error):
+      pass
+
+  async def fetch(self, _URI, _timeout = TIMEOUT): # Get the response from the cache or the server
+    import asyncio
+    _key = _canonical(_URI)
+    _entry = await asyncio.to_thread(self.get, _key) if self.enabled else None # Don't hold up other requests
+    if _entry and _entry[0] > time.time():
+      self.hits += 1
+      return _entry[3]
+    _request = {}
+    if _entry: # Ask the server to only send the data if it has changed
+      if _entry[1]:
+        _request['If-None-Match'] = _entry[1]
+      if _entry[2]:
+        _request['If-Modified-Since'] = _entry[2]
+    try:
+      (_headers, _data) = await pool.get(_URI, _request, _timeout)
+      self.misses += 1
+    except urllib.error.HTTPError as _Error:
+      if _Error.code != 304 or not _entry: # Not modified
+        raise
+      _data = _entry[3]
+      _headers = _Error.headers
+      self.revalidated += 1
+    if self.enabled:
+      await asyncio.to_thread(self.put, _key, _expires(_headers, _data), _headers.get('ETag') or (_entry and _entry[1]),
+                              _headers.get('Last-Modified') or (_entry and _entry[2]), _data)
+    return _data
+
+  def stats(self):
+    return ('Responses : \t\t' + 'Hits: ' + str(self.hits) + '  Misses: ' + str(self.misses) +
+            '  Revalidated: ' + str(self.revalidated) + '\n')
+
+cache = responses()
+
+metrics.add(lambda: collections.OrderedDict([('cache_hits_total', cache.hits), ('cache_misses_total', cache.misses),
+                                             ('cache_revalidated_total', cache.revalidated),
+                                             ('connections_opened_total', pool.opened), ('connections_reused_total', pool.reused),
+                                             ('connections_reconnected_total', pool.reconnected),
+                                             ('rate_limit_waits_total', limit.waits)]))
+
+
+place = collections.namedtuple('place', ['id', 'name', 'latitude', 'longitude']) # City in the index
+
+def _point(_latitude, _longitude): # Position on a sphere with a radius of one (so the nearest cities are also the nearest points)
+  import math
+  (_latitude, _longitude) = (math.radians(_latitude), math.radians(_longitude))
+  return (math.cos(_latitude) * math.cos(_longitude), math.cos(_latitude) * math.sin(_longitude), math.sin(_latitude))
+
+def _kilometres(_squared): # Convert the square of the distance between two points to the distance along the surface
+  import math
+  return 6371.0 * 2 * math.asin(min(1.0, math.sqrt(_squared) / 2))
+
+def _tree(_points, _entries): # Arrange the entries as a k-d tree (the middle entry in each range splits the rest)
+  _order = [0] * len(_entries)
+  _ranges = [(0, len(_entries), _entries, 0)]
+  while _ranges:
+    (_low, _high, _entries, _axis) = _ranges.pop()
+    if _low < _high:
+      _entries = sorted(_entries, key = lambda _entry: _points[_entry][_axis])
+      _middle = (_low + _high) // 2
+      _order[_middle] = _entries[_middle - _low]
+      _ranges.append((_low, _middle, _entries[:_middle - _low], (_axis + 1) % 3))
+      _ranges.append((_middle + 1, _high, _entries[_middle - _low + 1:], (_axis + 1) % 3))
+  return _order
+
+def build_index(_source, _path = CITY_INDEX): # Build the index from the bulk city list (city.list.json or city.list.json.gz)
+  import json, gzip, array
+  with (gzip.open if _source.endswith('.gz') else open)(_source, 'rb') as _file:
+    _cities = json.load(_file)
+  _entries = [] # Key (used to search), name and city
+  for _city in _cities:
+    _parts = [_city['name'], _city.get('state') or '', _city.get('country') or '']
+    _name = ','.join([_part for _part in _parts if _part]) # Same format as the locations
+    _entries.append((normalize(_name).encode('utf-8'), _name, _city))
+    if _parts[1]: # Can also be found without the state
+      _entries.append((normalize(_parts[0] + ',' + _parts[2]).encode('utf-8'), _name, _city))
+  _entries.sort(key = lambda _entry: (_entry[0], _entry[2]['id']))
+  (_ids, _latitudes, _longitudes, _offsets) = (array.array('I'), array.array('f'), array.array('f'), array.array('I', [0]))
+  _text = bytearray()
+  _first = collections.OrderedDict() # First entry for each city (only these are added to the tree)
+  for (_index, (_key, _name, _city)) in enumerate(_entries):
+    _ids.append(_city['id'])
+    _latitudes.append(_city['coord']['lat'])
+    _longitudes.append(_city['coord']['lon'])
+    _text += _key + b'\0' + _name.encode('utf-8')
+    _offsets.append(len(_text))
+    _first.setdefault(_city['id'], _index)
+  _points = dict([(_entry, _point(_latitudes[_entry], _longitudes[_entry])) for _entry in _first.values()])
+  _nodes = array.array('I', _tree(_points, list(_first.values())))
+  _coordinates = [array.array('f', [_points[_entry][_axis] for _entry in _nodes]) for _axis in range(3)]
+  os.makedirs(os.path.dirname(os.path.abspath(_path)), exist_ok = True)
+  _temp = _path + '.' + str(os.getpid()) # Write to a temporary file first so a partial index is never used
+  with open(_temp, 'wb') as _file:
+    _file.write(index.HEADER.pack(index.MAGIC, index.VERSION, len(_entries), len(_nodes), len(_text)))
+    for _array in [_ids, _latitudes, _longitudes, _offsets, _nodes] + _coordinates:
+      _file.write(_array.tobytes())
+    _file.write(_text)
+  os.replace(_temp, _path)
+  return len(_first)
+
+
+class index(object): # Index of the cities in the bulk city list (memory mapped so it doesn't have to be loaded)
+
+  HEADER = struct.Struct('=4sIIII') # Magic, version (also used to check the byte order), entries, cities and size of the text
+  MAGIC = b'OWCI'
+  VERSION = 1
+
+  class keys(object): # Sorted keys (so they can be searched using bisect)
+    def __init__(self, _index):
+      self.index = _index
+    def __len__(self):
+      return self.index.count
+    def __getitem__(self, _entry):
+      return self.index.text(_entry)[0]
+
+  def __init__(self, _path = CITY_INDEX):
+    self.path = _path
+    self.enabled = True
+    self.loaded = False
+    self.lock = threading.Lock()
+    self.count = 0
+
+  def load(self): # Map the index into memory the first time it is used
+    if not self.loaded:
+      with self.lock:
+        if not self.loaded:
+          self.open()
+          self.loaded = True
+    return self.enabled and self.count > 0
+
+  def open(self):
+    import mmap
+    try:
+      with open(self.path, 'rb') as _file:
+        self.map = mmap.mmap(_file.fileno(), 0, access = mmap.ACCESS_READ)
+      (_magic, _version, _count, _cities, _size) = self.HEADER.unpack_from(self.map)
+    except (OSError, ValueError, struct.error): # Not built yet
+      return
+    if _magic != self.MAGIC or _version != self.VERSION: # Built by a different version (or on a different machine)
+      return
+    _view = memoryview(self.map)
+    _sections = []
+    _offset = self.HEADER.size
+    for (_length, _type) in [(_count, 'I'), (_count, 'f'), (_count, 'f'), (_count + 1, 'I'), (_cities, 'I'), (_cities, 'f'), (_cities, 'f'), (_cities, 'f')]:
+      _sections.append(_view[_offset:_offset + _length * 4].cast(_type))
+      _offset += _length * 4
+    (self.ids, self.latitudes, self.longitudes, self.offsets, self.nodes) = _sections[:5]
+    self.coordinates = _sections[5:] # Position of each node
+    self.characters = _view[_offset:_offset + _size]
+    self.count = _count
+
+  def text(self, _entry): # Key and name
+    (_key, _name) = bytes(self.characters[self.offsets[_entry]:self.offsets[_entry + 1]]).split(b'\0')
+    return _key, _name
+
+  def place(self, _entry):
+    return place(self.ids[_entry], self.text(_entry)[1].decode('utf-8'), self.latitudes[_entry], self.longitudes[_entry])
+
+  def find(self, _prefix, _limit = 20): # Cities with names starting with prefix
+    if not self.load():
+      return []
+    _prefix = normalize(_prefix).encode('utf-8')
+    _keys = self.keys(self)
+    _places = []
+    _entry = bisect.bisect_left(_keys, _prefix)
+    _ids = set()
+    while _entry < self.count and len(_places) < _limit and _keys[_entry].startswith(_prefix):
+      if not self.ids[_entry] in _ids: # Cities with a state can be found with or without it
+        _ids.add(self.ids[_entry])
+        _places.append(self.place(_entry))
+      _entry += 1
+    return _places
+
+  def resolve(self, _location): # City ID for a location (if it is a city ID or there is only one city with that name)
+    if _location[:1] == '#' and _location[1:].isdigit():
+      return int(_location[1:])
+    if not self.load():
+      return None
+    _key = normalize(_location).encode('utf-8')
+    _keys = self.keys(self)
+    _start = bisect.bisect_left(_keys, _key)
+    _ids = set()
+    _entry = _start
+    while _entry < self.count and _keys[_entry] == _key: # Same name (and country)
+      _ids.add(self.ids[_entry])
+      _entry += 1
+    if not _ids: # Just the name (or without the state)
+      while _entry < self.count and len(_ids) < 2 and _keys[_entry].startswith(_key + b','):
+        _ids.add(self.ids[_entry])
+        _entry += 1
+    return _ids.pop() if len(_ids) == 1 else None
+
+  def near(self, _latitude, _longitude, _count = 1): # Nearest cities and their distance (in km)
+    if not self.load():
+      return []
+    _target = _point(_latitude, _longitude)
+    _found = [] # Nearest nodes found so far (furthest first)
+    _ranges = [(0, len(self.nodes), 0, 0.0)] # Nodes still to search, the axis they are split on and how near they could be
+    while _ranges:
+      (_low, _high, _axis, _bound) = _ranges.pop()
+      if _low >= _high or (len(_found) == _count and _bound >= -_found[0][0]): # Nothing in this range can be nearer
+        continue
+      _middle = (_low + _high) // 2
+      _node = [_coordinates[_middle] for _coordinates in self.coordinates]
+      _squared = sum([(_a - _b) ** 2 for (_a, _b) in zip(_target, _node)])
+      if len(_found) < _count:
+        heapq.heappush(_found, (-_squared, _middle))
+      elif _squared < -_found[0][0]:
+        heapq.heapreplace(_found, (-_squared, _middle))
+      _difference = _target[_axis] - _node[_axis]
+      (_near, _far) = ((_low, _middle), (_middle + 1, _high)) if _difference < 0 else ((_middle + 1, _high), (_low, _middle))
+      _ranges.append(_far + ((_axis + 1) % 3, _difference ** 2))
+      _ranges.append(_near + ((_axis + 1) % 3, _bound)) # Search the side the point is on first
+    return [(_kilometres(-_squared), self.place(self.nodes[_middle])) for (_squared, _middle) in sorted(_found, reverse = True)]
+
+cities = index()
+
+
+class result(object): # Weather at a location, or why it couldn't be fetched
+
+  __slots__ = ('location', 'status', 'error', 'retry', 'data')
+
+  def __init__(self, _location, _data = None, _status = 0, _error = '', _retry = 0):
+    self.location = _location
+    self.data = _data # Response converted to a dictionary
+    self.status = _status # 0 if successful, the HTTP status or -1 for any other error
+    self.error = _error
+    self.retry = _retry # How long the server asked us to wait
+
+def parser(_names = JSON_PARSERS): # Name and function of the first JSON parser that is installed
+  import importlib
+  for _name in _names:
+    try:
+      return _name, importlib.import_module(_name).loads
+    except ImportError:
+      pass
+  raise ImportError('No JSON parser (' + ', '.join(_names) + ')')
+
+_loads = None # JSON parser (see loads())
+
+def loads(_data): # Parse JSON using the fastest parser available
+  global _loads
+  if _loads is None:
+    _loads = parser()[1]
+  return _loads(_data)
+
+def elements(_data, _tags = None): # Attributes (and text) of each element in an XML document (or just those with the tags given)
+  import xml.parsers.expat
+  _elements = {}
+  _current = [None] # Element being read (if it is needed)
+  def _start(_tag, _attributes):
+    if (_tags is None or _tag in _tags) and not _tag in _elements:
+      _elements[_tag] = _current[0] = _attributes
+    else:
+      _current[0] = None
+  def _end(_tag):
+    _current[0] = None
+  def _text(_text):
+    if _current[0] is not None and _text.strip():
+      _current[0]['#text'] = _current[0].get('#text', '') + _text.strip()
+  _parser = xml.parsers.expat.ParserCreate() # Streaming parser (that only calls back for each element instead of building a tree)
+  _parser.buffer_text = True
+  (_parser.StartElementHandler, _parser.EndElementHandler, _parser.CharacterDataHandler) = (_start, _end, _text)
+  _parser.Parse(_data, True)
+  return _elements
+
+def _parse(_data, _mode, _fields = None): # Convert the response to a dictionary
+  if _mode == 'xml':
+    return elements(_data, _fields)
+  return loads(_data)
+
+async def _attempt(_location, _URI, _mode, _timeout, _fields = None): # Send a request and return the result (or error)
+  import asyncio
+  try:
+    _data = await cache.fetch(_URI, _timeout)
+    with metrics.timer('parse'):
+      return result(_location, _parse(_data, _mode, _fields))
+  except urllib.error.HTTPError as _Error:
+    if _Error.code == 404:
+      _message = 'Location (' + _location + ') not found.'
+    elif _Error.code == 401:
+      _message = 'Check your application ID is valid.'
+    else:
+      _message = str(_Error.reason)
+    return result(_location, None, _Error.code, _message, _retry_after(_Error.headers))
+  except asyncio.TimeoutError:
+    return result(_location, None, -1, 'Timed out')
+  except (urllib.error.URLError, OSError) as _Error: # Network errors
+    return result(_location, None, -1, str(getattr(_Error, 'reason', _Error)))
+  except asyncio.CancelledError:
+    raise
+  except Exception as _Error: # Anything else (such as an invalid response)
+    return result(_location, None, -1, type(_Error).__name__ + ': ' + str(_Error))
+
+async def fetch(_location, _appid, _mode = 'json', _units = 'metric', _language = None, _timeout = TIMEOUT, _fields = None): # Get the weather at a location (only the XML elements in fields if given)
+  _id = cities.resolve(_location) # Don't need the server to look up the name if the city ID is known
+  _URI = (API + 'weather?units=' + urllib.parse.quote(_units) + ('&mode=xml' if _mode == 'xml' else '') +
+          ('&id=' + str(_id) if _id else '&q=' + urllib.parse.quote(_location)) +
+          ('&lang=' + _language if _language else '') + '&appid=' + urllib.parse.quote(_appid))
+  return await _attempt(_location, _URI, _mode, _timeout, _fields)
+
+async def group(_ids, _appid, _units = 'metric', _language = None, _timeout = TIMEOUT): # Get the weather for several cities (by city ID) with one request
+  _URI = (API + 'group?units=' + urllib.parse.quote(_units) + '&id=' + ','.join([str(_id) for _id in _ids]) +
+          ('&lang=' + _language if _language else '') + '&appid=' + urllib.parse.quote(_appid))
+  _result = await _attempt(','.join([str(_id) for _id in _ids]), _URI, 'json', _timeout)
+  if not _result.status: # Weather for each city ID
+    try:
+      _result.data = dict([(_weather['id'], _weather) for _weather in _result.data['list']])
+    except (KeyError, TypeError) as _Error: # Anything else (such as an invalid response)
+      return result(_result.location, None, -1, 'Invalid response (' + type(_Error).__name__ + ': ' + str(_Error) + ')')
+  return _result
+
+async def fetch_each(_locations, _appid, _jobs = JOBS, **_options): # Yield the result for each location in order as soon as it is available
+  import asyncio
+  _semaphore = asyncio.Semaphore(_jobs)
+  async def _limited(_location):
+    async with _semaphore:
+      return await fetch(_location, _appid, **_options)
+  _pending = collections.deque() # Key and request for each location (in order)
+  _tasks = {} # Request for each location in the queue and the number of times it is queued
+  _recent = collections.OrderedDict() # Results for the most recent locations (so repeated ones are only fetched once)
+  async def _next(): # Wait for the next result (only keeping the request until the last time it is needed)
+    (_key, _task) = _pending.popleft()
+    _result = await _task
+    _tasks[_key][1] -= 1
+    if not _tasks[_key][1]:
+      del _tasks[_key]
+      _recent[_key] = _result
+      _recent.move_to_end(_key)
+      if len(_recent) > REPEATS:
+        _recent.popitem(last = False)
+    return _result
+  try:
+    for _location in _locations:
+      _key = normalize(_location)
+      if not _key in _tasks:
+        if _key in _recent: # Already fetched
+          _tasks[_key] = [asyncio.get_running_loop().create_future(), 0]
+          _tasks[_key][0].set_result(_recent[_key])
+        else:
+          _tasks[_key] = [asyncio.ensure_future(_limited(_location)), 0]
+      _tasks[_key][1] += 1
+      _pending.append((_key, _tasks[_key][0]))
+      if len(_pending) >= _jobs * BACKLOG: # Don't queue up too many requests
+        yield await _next()
+    while _pending:
+      yield await _next()
+  finally: # Cancel anything that is still running if we stop early
+    for (_task, _count) in _tasks.values():
+      _task.cancel()
+
+async def fetch_many(_locations, _appid, _jobs = JOBS, **_options): # Get the weather at each location
+  return [_result async for _result in fetch_each(_locations, _appid, _jobs, **_options)]
+
+def run(_coroutine): # Run a coroutine in a new event loop (closing any connections it opened)
+  import asyncio
+  async def _main():
+    try:
+      return await _coroutine
+    finally:
+      pool.close()
+  return asyncio.run(_main())
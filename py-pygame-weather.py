@@ -77,169 +77,829 @@
 #                     - Added '--noip' and '--nologo' options - MT
 #   29 Apr 26         - Moved folder containing icons - MT 
 #    5 May 26         - Updated icons - MT
+#   18 Oct 26   0.4   - Rasterized icons are kept in a  (bounded)  cache so
+#                       each  icon is only converted from SVG once for each
+#                       width instead of on every frame - MT
+#                     - Rendered icons are also saved on disk (named using
+#                       a  hash of the SVG file, width and DPI) so they are
+#                       not rendered again the next time it is started - MT
+#                     - Added '--prerender' option to render all the icons
+#                       in parallel at the default sizes and exit - MT
+#                     - Each icon is drawn once on its own surface when the
+#                       weather  data or size changes, and only the  parts
+#                       of the display that have changed are updated - MT
+#                     - Waits  for an event or until the next update is due
+#                       instead of polling for events,  and only uses  one
+#                       clock to limit the frame rate - MT
+#                     - Displays the number of times it woke up and how long
+#                       it took to draw each frame in the verbose output - MT
+#                     - Gets  the weather for all the locations at the same
+#                       time  using a pool of threads (the number of  which
+#                       can be set using the '--jobs' option) - MT
+#                     - Fixed location name in error messages - MT
+#                     - The weather is updated in the background so a slow
+#                       response  can't stop the display from  responding,
+#                       and requests now time out - MT
+#                     - If an update fails it keeps displaying the previous
+#                       weather (in a different colour) and tries again at
+#                       increasing intervals - MT
+#                     - Once the city ID of a location is known (and saved)
+#                       the weather for up to 20 locations is fetched using
+#                       a single request - MT
+#                     - Responses are kept in a cache shared by all running
+#                       copies (and py-weather.py) until the data is likely
+#                       to have changed - MT
+#                     - Added '--nocache' option - MT
+#                     - Reuses connections to the server and asks for  the
+#                       data to be compressed - MT
+#                     - Added '--base-url' option to use a different server
+#                       (such as py-weather-server.py) - MT
+#                     - Only loads each font size once and keeps a cache of
+#                       rendered text - MT
+#                     - Only keeps the values used from each response  (in
+#                       a  snapshot object)  and formats the text that  is
+#                       displayed once when the weather is updated - MT
+#                     - Added  '--locations-file' option to read  locations
+#                       from a file (or stdin) - MT
+#                     - Repeated locations are ignored - MT
+#                     - Updates  are spread out over the  update  interval
+#                       (with  a  different offset on each host)  and  the
+#                       number of requests sent each minute is limited - MT
+#                     - Waits for as long as the server asks if it  is  too
+#                       busy (using Retry-After) - MT
+#                     - The first location is always updated first - MT
+#                     - Opens the display straight away showing the  name
+#                       of each location until the weather is available,
+#                       and rasterizes the icons in the background - MT
+#                     - Only imports pygame when the display is opened and
+#                       restores print() afterwards - MT
+#                     - The '--debug' option also reports how long it took
+#                       to import each module and to draw the first  frame
+#                       (also displayed by '--verbose') - MT
+#                     - Keeps  a history of the temperature, humidity,
+#                       pressure  and wind speed at each location (in a
+#                       separate file for each value which is read using
+#                       mmap), averaging older values over each hour and
+#                       discarding them after five years - MT
+#                     - Added '--nohistory' option - MT
+#                     - Displays  the temperature and pressure over  the
+#                       last day below each icon (which is only drawn
+#                       again when there is a new observation) - MT
+#                     - Added '--boards' option to save boards for several
+#                       sets of locations (each with its own size) as PNG
+#                       files without a display,  drawing them  in several
+#                       processes and only saving those that have changed,
+#                       and '--once' option to exit after saving them - MT
+#                     - Icons are scaled to suit the height of the display
+#                       (or board) - MT
+#                     - Uses openweather.py (shared with py-weather.py) to
+#                       get the weather, sending all the requests at  the
+#                       same time using asyncio - MT
+#                     - An unexpected response no longer stops it - MT
+#                     - Records how long it takes to rasterize each icon,
+#                       render text, draw and blit each icon and update the
+#                       display (as well as each stage of a request) - MT
+#                     - Added '--metrics' option to serve the timings and
+#                       counters in Prometheus format, which are also
+#                       summarized on exit by '--verbose' - MT
+#                     - Added '--profile' option to profile a run - MT
+#                     - Looks up locations in the city index (built using
+#                       py-weather.py) so the weather for every  location
+#                       can be fetched using its city ID the first time it
+#                       is started ('--noindex' to disable) - MT
+#                     - Added  '--near' option to display the weather  at
+#                       the nearest city to a latitude and longitude - MT
+#                     - Locations that don't fit on the display are no longer
+#                       ignored.  Instead they are split into pages  which
+#                       are drawn on their own surfaces when the weather
+#                       changes and scrolled in turn - MT
+#                     - Added '--page-time' option - MT
+#                     - Uses startup.py (shared with py-weather.py) to time
+#                       the imports - MT
+#                     - Doesn't import asyncio (or concurrent.futures) until
+#                       it is needed, after the display has been opened - MT
 #
 # To Do:              - Specify icon folder on the command line.
 #                     - Create icons for each weather id...
 #
 
 NAME = "Weather Display"
-VERSION = "0.3"
+VERSION = "0.4"
 
 DISPLAY_SIZE = DISPLAY_WIDTH, DISPLAY_HEIGHT = (800, 480)
 FPS = 30
+WAIT_TIME = 1000 # Longest time to wait for an event (ms)
 INTERVAL = 900 # Update interval
+GROUP_SIZE = 20 # Maximum number of cities in each request
+HISTORY_COLUMNS = ('temperature', 'humidity', 'pressure', 'speed') # Values kept for each observation
+HISTORY_RAW = 30 * 86400 # How long to keep every observation
+HISTORY_STEP = 3600 # Older observations are averaged over this period
+HISTORY_KEEP = 5 * 365 * 86400 # How long to keep the averages
+RETRY = 15 # Initial delay before retrying a failed update
+JOBS = 8 # Maximum number of locations to fetch at the same time
+RATE_LIMIT = 50 # Maximum number of requests each minute (as it runs all the time)
+BURST = 10 # Maximum number of requests that can be sent at once
+ICON_CACHE_SIZE = 32 # Maximum number of rasterized icons to keep
+TEXT_CACHE_SIZE = 256 # Maximum number of rendered strings to keep
+ICON_SCALE = 0.752 # Width of the graphic relative to the width of the icon
+ICON_WIDTHS = (288, 96) # Icon sizes used on the display
+PAGE_TIME = 15 # How long each page of locations is displayed
+SCROLL_TIME = 0.8 # Time taken to scroll to the next page
+ICON_FOLDER = './ico/'
 
 BACKGROUND_COLOUR = 'grey10'
 TEXT_COLOUR = 'white'
 DARKTEXT_COLOUR = 'dark grey'
+STALE_COLOUR = 'grey40' # Used when the weather data is out of date
+TEMPERATURE_COLOUR = 'darkorange' # Trends
+PRESSURE_COLOUR = 'steelblue'
+TREND_PERIOD = 86400 # Period covered by the trends
 
-import io, os, sys, time
-import urllib.request, urllib.error, json
-import traceback, builtins
+import sys, time, builtins, threading
 
-# Bit of an ugly hack to suppress pygame banner message...
+_started = time.perf_counter() # Used to measure how long it takes to start
 
-# _print = builtins.print # Save current print function definition
-builtins.print = lambda *args, **kwargs: None # Redefine print so it doesn't do anything!
-import pygame # Won't print banner as print() doesn't do anything anymore
-#builtins.print = _print # Restore print function if needed!
+
+import startup # Times each import if '--debug' is specified (so it has to be imported first)
+
+import io, os, array, bisect
+import collections, hashlib, zlib, socket
+import json, traceback
+import openweather
+
+CACHE_FOLDER = openweather.CACHE_FOLDER
+ICON_CACHE = os.path.join(CACHE_FOLDER, 'icons') # Rendered icons
+CITY_CACHE = os.path.join(CACHE_FOLDER, 'cities.json') # City ID for each location
+HISTORY_FOLDER = os.path.join(CACHE_FOLDER, 'history') # Previous observations at each location
+
+pygame = None # Only imported when it is needed (see _pygame())
+
+def _pygame(): # Import pygame (which takes a while)
+  global pygame
+  if pygame is None:
+    # Bit of an ugly hack to suppress pygame banner message...
+    _print = builtins.print # Save current print function definition
+    builtins.print = lambda *args, **kwargs: None # Redefine print so it doesn't do anything!
+    try:
+      import pygame # Won't print banner as print() doesn't do anything anymore
+    finally:
+      builtins.print = _print # Restore print function
+  return pygame
+
+
+numpy = None # Only imported when it is needed (see _resample())
+
+def _resample(_times, _values, _start, _end, _width): # Interpolate values at each pixel (using numpy if it is available)
+  global numpy
+  if numpy is None:
+    try:
+      import numpy
+    except ImportError:
+      numpy = False
+  _scale = (_width - 1) / (_end - _start)
+  if numpy:
+    _times = numpy.frombuffer(_times, dtype = _times.typecode).astype(float)
+    _values = numpy.frombuffer(_values, dtype = _values.typecode)
+    _valid = ~numpy.isnan(_values) # Ignore missing values
+    (_times, _values) = (_times[_valid], _values[_valid])
+    if len(_times) < 2:
+      return []
+    _x = numpy.arange(max(0, int(numpy.ceil((_times[0] - _start) * _scale))), min(_width, int((_times[-1] - _start) * _scale) + 1))
+    return list(zip(_x.tolist(), numpy.interp(_start + _x / _scale, _times, _values).tolist()))
+  _samples = [(_time, _value) for (_time, _value) in zip(_times, _values) if _value == _value] # Ignore missing values (NaN)
+  if len(_samples) < 2:
+    return []
+  _times = [_time for (_time, _value) in _samples]
+  _points = []
+  for _x in range(max(0, -int(-(_times[0] - _start) * _scale)), min(_width, int((_times[-1] - _start) * _scale) + 1)):
+    _time = _start + _x / _scale
+    _index = min(max(bisect.bisect_left(_times, _time), 1), len(_times) - 1)
+    ((_t0, _v0), (_t1, _v1)) = (_samples[_index - 1], _samples[_index])
+    _points.append((_x, _v0 + (_v1 - _v0) * (_time - _t0) / (_t1 - _t0) if _t1 > _t0 else _v1))
+  return _points
+
+def _render(_filename, _width): # Render svg as png in the disk cache and return the path
+  with open(_filename, 'rb') as _file:
+    _hash = hashlib.sha1(_file.read()).hexdigest()
+  _dpi = 96 / (_width / 64)
+  _path = os.path.join(ICON_CACHE, '%s-%g-%g.png' % (_hash, _width, _dpi))
+  if not os.path.exists(_path):
+    import cairosvg
+    with openweather.metrics.timer('rasterize'):
+      _svg = cairosvg.svg2svg(url = _filename, dpi = _dpi) # Convert svg to svg changing DPI to resize the image
+      _bytes = cairosvg.svg2png(_svg)
+    os.makedirs(ICON_CACHE, exist_ok = True)
+    _temp = _path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) # Write to a temporary file first so a partial file is never used
+    with open(_temp, 'wb') as _file:
+      _file.write(_bytes)
+    os.replace(_temp, _path)
+  return _path
+
+def _prerender(): # Render every icon at each of the sizes used in parallel
+  import glob, concurrent.futures
+  _files = sorted(glob.glob(os.path.join(ICON_FOLDER, '*.svg')))
+  _widths = [_width * ICON_SCALE for _width in ICON_WIDTHS]
+  with concurrent.futures.ProcessPoolExecutor() as _pool:
+    _jobs = [_pool.submit(_render, _file, _width) for _file in _files for _width in _widths]
+    for _job in concurrent.futures.as_completed(_jobs):
+      _job.result() # Raise any errors
+  return len(_jobs)
+
+
+class icons(object): # Least recently used cache of rasterized icons
+
+  def __init__(self, _size = ICON_CACHE_SIZE):
+    self.size = _size
+    self.hits = 0
+    self.misses = 0
+    self.images = collections.OrderedDict()
+
+  def load(self, _filename, _width): # Convert svg to a surface of the required width
+    try:
+      return pygame.image.load(_render(_filename, _width))
+    except OSError: # Render it in memory if the disk cache can't be used
+      import cairosvg
+      with openweather.metrics.timer('rasterize'):
+        _svg = cairosvg.svg2svg(url = _filename, dpi = (96 / (_width / 64)))
+        return pygame.image.load(io.BytesIO(cairosvg.svg2png(_svg)))
+
+  def get(self, _filename, _width):
+    _key = (_filename, _width)
+    if _key in self.images:
+      self.hits += 1
+      self.images.move_to_end(_key) # Mark as most recently used
+      return self.images[_key]
+    self.misses += 1
+    _image = self.load(_filename, _width)
+    self.images[_key] = _image
+    while len(self.images) > self.size: # Discard the least recently used icons
+      self.images.popitem(last = False)
+    return _image
+
+  def stats(self):
+    return ('Icon cache : \t\t' + str(len(self.images)) + '/' + str(self.size) +
+            ' (Hits: ' + str(self.hits) + '  Misses: ' + str(self.misses) + ')\n')
+
+_icons = icons()
+
+
+class fonts(object): # Font for each size and a least recently used cache of rendered text
+
+  def __init__(self, _size = TEXT_CACHE_SIZE):
+    self.size = _size
+    self.hits = 0
+    self.misses = 0
+    self.fonts = {}
+    self.images = collections.OrderedDict()
+
+  def font(self, _size):
+    if not _size in self.fonts:
+      self.fonts[_size] = pygame.font.Font(None, _size)
+    return self.fonts[_size]
+
+  def render(self, _text, _size, _colour):
+    _key = (_text, _size, _colour)
+    if _key in self.images:
+      self.hits += 1
+      self.images.move_to_end(_key) # Mark as most recently used
+      return self.images[_key]
+    self.misses += 1
+    with openweather.metrics.timer('text'):
+      _image = self.font(_size).render(_text, True, pygame.Color(_colour))
+    self.images[_key] = _image
+    while len(self.images) > self.size: # Discard the least recently used text
+      self.images.popitem(last = False)
+    return _image
+
+  def clear(self):
+    self.fonts.clear()
+    self.images.clear()
+
+  def stats(self):
+    return ('Text cache : \t\t' + str(len(self.images)) + '/' + str(self.size) +
+            ' (Hits: ' + str(self.hits) + '  Misses: ' + str(self.misses) + '  Fonts: ' + str(len(self.fonts)) + ')\n')
+
+_fonts = fonts()
+
+
+_cities = {} # City ID for each location
+
+def _load_cities():
+  try:
+    with open(CITY_CACHE) as _file:
+      _cities.update(json.load(_file))
+  except (OSError, ValueError): # Not an error if it doesn't exist (yet)
+    pass
+
+def _save_cities():
+  try:
+    os.makedirs(CACHE_FOLDER, exist_ok = True)
+    _temp = CITY_CACHE + '.' + str(os.getpid())
+    with open(_temp, 'w') as _file:
+      json.dump(dict(_cities), _file, indent = 2)
+    os.replace(_temp, CITY_CACHE)
+  except OSError:
+    pass
+
+async def _group(_items, _jobs): # Update the weather for a group of locations using a single request
+  async with _jobs:
+    _result = await openweather.group([_cities[_item.key] for _item in _items], _items[0].appid, _items[0].units, openweather.language())
+  for _item in _items: # Missing results will be fetched individually
+    if _result.status: # Request for the whole group failed
+      _item.refresh(openweather.result(_item.location, None, _result.status, _result.error, _result.retry))
+    elif _cities[_item.key] in _result.data:
+      _item.refresh(openweather.result(_item.location, _result.data[_cities[_item.key]]))
+    else:
+      await _single(_item, _jobs)
+
+async def _single(_item, _jobs): # Update the weather for one location
+  async with _jobs:
+    _item.refresh(await openweather.fetch(_item.location, _item.appid, 'json', _item.units, openweather.language()))
+
+async def _requests(_items, _jobs): # Send the requests (most important first) at the same time
+  import asyncio
+  _count = len(_cities)
+  for _item in _items:
+    if not _item.key in _cities:
+      _id = openweather.cities.resolve(_item.location) # City ID may be in the index
+      if _id:
+        _cities[_item.key] = _id
+  _items = sorted(_items, key = lambda _item: _item.priority)
+  _known = [_item for _item in _items if _item.key in _cities]
+  _other = [_item for _item in _items if not _item.key in _cities]
+  _groups = [_known[_index:_index + GROUP_SIZE] for _index in range(0, len(_known), GROUP_SIZE)]
+  _requests = [(_members[0].priority, _group, _members) for _members in _groups]
+  _requests += [(_item.priority, _single, _item) for _item in _other]
+  _requests.sort(key = lambda _request: _request[0])
+  _jobs = asyncio.Semaphore(_jobs) # Limits the number of requests sent at the same time
+  await asyncio.gather(*[_function(_argument, _jobs) for (_priority, _function, _argument) in _requests])
+  if len(_cities) != _count: # Save any new city IDs
+    _save_cities()
+
+def _update(_items, _jobs = JOBS): # Update the weather using as few requests as possible
+  openweather.run(_requests(_items, _jobs))
+
+
+class snapshot(object): # Weather conditions at a location (extracted from the response)
+
+  __slots__ = ('city', 'name', 'country', 'latitude', 'longitude', 'code', 'symbol', 'icon', 'description', 'summary',
+               'temperature', 'humidity', 'pressure', 'clouds', 'speed', 'direction',
+               'sunrise', 'sunset', 'updated', 'timezone', 'temperature_text', 'humidity_text')
+
+  def __init__(self, _weather):
+    _conditions = _weather['weather'][0]
+    self.city = _weather['id']
+    self.name = _weather['name']
+    self.country = _weather['sys'].get('country', '')
+    self.latitude = float(_weather['coord']['lat'])
+    self.longitude = float(_weather['coord']['lon'])
+    self.code = _conditions['id']
+    self.symbol = _conditions['icon'] # Icon name used by Open Weather
+    self.icon = str(_conditions['id']) + _conditions['icon'][-1:] # Weather code and day or night
+    self.description = _conditions['description'].title()
+    self.summary = self.description.replace('Intensity ', '') # 'Heavy Rain' looks better than 'Heavy Intensity Rain'
+    self.temperature = float(_weather['main']['temp'])
+    self.humidity = float(_weather['main']['humidity'])
+    self.pressure = float(_weather['main']['pressure'])
+    self.clouds = _weather.get('clouds', {}).get('all') # May not be available
+    self.speed = _weather.get('wind', {}).get('speed')
+    self.direction = _weather.get('wind', {}).get('deg')
+    self.sunrise = _weather['sys'].get('sunrise')
+    self.sunset = _weather['sys'].get('sunset')
+    self.updated = _weather['dt']
+    self.timezone = _weather.get('timezone', 0)
+    self.temperature_text = '%.0f' % round(self.temperature) + 'C'
+    self.humidity_text = u'(' + ('%d' % self.humidity) + u'%)'
+
+  def local(self, _time): # Convert time to local time at the location
+    import datetime
+    return (datetime.datetime.utcfromtimestamp(_time) + datetime.timedelta(seconds=self.timezone)).strftime('%Y-%m-%dT%H:%M:%S')
+
+  def dict(self):
+    return dict([(_name, getattr(self, _name)) for _name in self.__slots__])
+
+
+class history(object): # Observations at each location, with each value kept in a separate file so it can be read as an array
+
+  TYPES = dict([('time', 'I')] + [(_name, 'f') for _name in HISTORY_COLUMNS])
+  TIERS = ('hourly', 'raw') # Averages and recent observations (oldest first)
+
+  def __init__(self, _path = HISTORY_FOLDER):
+    self.path = _path
+    self.enabled = True
+    self.added = 0
+    self.compacted = 0
+
+  def file(self, _city, _tier, _name):
+    return os.path.join(self.path, str(_city), _tier + '-' + _name)
+
+  def lock(self, _city, _exclusive = True): # Stop other processes changing the files (closing the file releases the lock)
+    import fcntl
+    os.makedirs(os.path.join(self.path, str(_city)), exist_ok = True)
+    _file = open(os.path.join(self.path, str(_city), 'lock'), 'a')
+    fcntl.flock(_file, fcntl.LOCK_EX if _exclusive else fcntl.LOCK_SH)
+    return _file
+
+  def columns(self): # Empty array for each value
+    return collections.OrderedDict([(_name, array.array(self.TYPES[_name])) for _name in ('time',) + HISTORY_COLUMNS])
+
+  def read(self, _city, _tier, _start = 0, _end = 2 ** 32 - 1): # Get the values between two times
+    import mmap
+    _columns = self.columns()
+    _size = _columns['time'].itemsize
+    try:
+      with open(self.file(_city, _tier, 'time'), 'rb') as _file:
+        _count = os.fstat(_file.fileno()).st_size // _size # Values may have been written without a time (which are ignored)
+        if not _count: # Can't map an empty file
+          return _columns
+        with mmap.mmap(_file.fileno(), 0, access = mmap.ACCESS_READ) as _map:
+          with memoryview(_map) as _view, _view[:_count * _size].cast(self.TYPES['time']) as _times:
+            (_first, _last) = (bisect.bisect_left(_times, _start), bisect.bisect_left(_times, _end))
+          _columns['time'].frombytes(_map[_first * _size:_last * _size])
+      for _name in HISTORY_COLUMNS:
+        _size = _columns[_name].itemsize
+        with open(self.file(_city, _tier, _name), 'rb') as _file:
+          with mmap.mmap(_file.fileno(), 0, access = mmap.ACCESS_READ) as _map:
+            _columns[_name].frombytes(_map[_first * _size:_last * _size])
+    except (OSError, ValueError): # No observations yet
+      return self.columns()
+    return _columns
+
+  def write(self, _city, _tier, _columns): # Replace the values
+    for _name in _columns:
+      _path = self.file(_city, _tier, _name)
+      with open(_path + '.' + str(os.getpid()), 'wb') as _file:
+        _columns[_name].tofile(_file)
+      os.replace(_path + '.' + str(os.getpid()), _path)
+
+  def add(self, _snapshot): # Append an observation (unless it is already there)
+    if not self.enabled:
+      return
+    _values = dict([(_name, getattr(_snapshot, _name)) for _name in HISTORY_COLUMNS])
+    try:
+      with self.lock(_snapshot.city):
+        _times = self.file(_snapshot.city, 'raw', 'time')
+        _size = array.array(self.TYPES['time']).itemsize
+        _count = os.path.getsize(_times) // _size if os.path.exists(_times) else 0
+        if _count:
+          with open(_times, 'rb') as _file:
+            _first = array.array(self.TYPES['time'], _file.read(_size))[0]
+            _file.seek((_count - 1) * _size)
+            if array.array(self.TYPES['time'], _file.read(_size))[0] >= _snapshot.updated:
+              return
+        for _name in HISTORY_COLUMNS + ('time',): # Time is written last so a partial observation is ignored
+          _value = int(_snapshot.updated) if _name == 'time' else _values[_name]
+          with open(self.file(_snapshot.city, 'raw', _name), 'ab') as _file:
+            _file.truncate(_count * array.array(self.TYPES[_name]).itemsize) # Discard any partial observation
+            array.array(self.TYPES[_name], [float('nan') if _value is None else _value]).tofile(_file)
+        self.added += 1
+        if _count and _first < time.time() - HISTORY_RAW - 86400: # Only compact the files once a day
+          self.compact(_snapshot.city)
+    except OSError: # Don't keep the history if the files can't be used
+      pass
+
+  def compact(self, _city): # Average older observations and discard any that are too old (files must be locked)
+    _now = time.time()
+    _raw = self.read(_city, 'raw')
+    _cutoff = int(_now - HISTORY_RAW) // HISTORY_STEP * HISTORY_STEP
+    _split = bisect.bisect_left(_raw['time'], _cutoff)
+    _hourly = self.read(_city, 'hourly', int(_now - HISTORY_KEEP))
+    _last = _hourly['time'][-1] if _hourly['time'] else -1
+    _buckets = collections.OrderedDict()
+    for _index in range(_split):
+      _time = _raw['time'][_index] // HISTORY_STEP * HISTORY_STEP
+      if _time > _last:
+        _buckets.setdefault(_time, []).append(_index)
+    for (_time, _indexes) in _buckets.items():
+      _hourly['time'].append(_time)
+      for _name in HISTORY_COLUMNS:
+        _values = [_raw[_name][_index] for _index in _indexes if _raw[_name][_index] == _raw[_name][_index]] # Ignore missing values (NaN)
+        _hourly[_name].append(sum(_values) / len(_values) if _values else float('nan'))
+    self.write(_city, 'hourly', _hourly)
+    self.write(_city, 'raw', collections.OrderedDict([(_name, _raw[_name][_split:]) for _name in _raw]))
+    self.compacted += 1
+
+  def query(self, _city, _start = 0, _end = 2 ** 32 - 1): # Get the observations between two times (oldest first)
+    _columns = self.columns()
+    try:
+      with self.lock(_city, False):
+        for _tier in self.TIERS:
+          for (_name, _values) in self.read(_city, _tier, _start, _end).items():
+            _columns[_name].extend(_values)
+    except OSError:
+      pass
+    return _columns
+
+  def stats(self):
+    return ('History : \t\t' + 'Added: ' + str(self.added) + '  Compacted: ' + str(self.compacted) + '\n')
+
+_history = history()
 
 
 class weather(object):
 
-  def __init__(self, _width, _location, _appid, _title = None):
+  def __init__(self, _width, _location, _appid, _title = None, _update = True):
     self.size = (self.width, self.height, ) = (_width, (_width + _width // 6))
     self.appid = _appid
     self.units = 'metric'
     self.location = _location
+    self.key = openweather.normalize(_location) # Used to look up the city ID
     self.description = ""
     self.status = 0 
     self.error = None
-    self.update() # Get the current weather for the specified location
+    self.image = None # Rendered icon
+    self.trend = None # Rendered trends
+    self.trend_key = None # Time of the last observation and width of the trends
+    self.changed = True # Set when the icon needs to be drawn again
+    self.stale = False # Set when the last update failed
+    self.failures = 0
+    self.retry = 0 # Time the server asked us to wait
+    self.due = 0 # When the next update is due
+    self.offset = 0 # When to update the weather in each interval
+    self.priority = 1 # Lower values are updated first
+    if _update:
+      self.refresh() # Get the current weather for the specified location
     
-  def update(self): # Update Weather data.
-    _locale = os.environ.get("LC_ALL") or os.environ.get("LANG") or os.environ.get("LC_CTYPE")
-    _URI = ('https://api.openweathermap.org/data/2.5/weather?units=' + 
-           urllib.parse.quote(self.units) + '&q=' + urllib.parse.quote(self.location) + '&lang=' + _locale.split('_')[0] + '&appid=' + urllib.parse.quote(self.appid ))
-
-    self.status = 0 # Clear any current errors
-    self.error = ''
-    try: 
-      _socket = urllib.request.urlopen(_URI)
-      _data=_socket.read()
-      _socket.close()
-      self.weather = json.loads(_data) # Convert XML response to a python dictionary 
-      self.description = self.weather['weather'][0]['description'].title().replace('Intensity ', '')
-      if _debug: 
-        sys.stderr.write (self.weather['name'] + "\n")
-        sys.stderr.write (json.dumps(self.weather, indent=4) + "\n") # Dump dictionary as JSON.
-      self.list()
-    except urllib.error.HTTPError as _Error:
-      self.status = _Error.code
-      if _Error.code == 404:
-        sys.stderr.write ('Error : ' + str(_Error.code) + ' - ' + 'Location (' + _location + ') not found.')
-        self.error = 'Location (' + _location + ') not found.'
-      elif _Error.code == 401: 
-        sys.stderr.write ('Error : ' + str(_Error.code) + ' - ' + 'Check your application ID is valid.')
-        self.error = 'Check your application ID is valid.'
+  def resize(self, _width): # Update size from width
+    if _width != self.width:
+      self.size = (self.width, self.height) = (_width, (_width + _width // 6))
+      self.changed = True
+
+  def refresh(self, _result = None): # Update weather data, waiting longer before trying again each time it fails
+    self.update(_result)
+    _now = time.time()
+    if self.status:
+      self.failures += 1
+      self.due = _now + max(min(RETRY * 2 ** (self.failures - 1), INTERVAL), self.retry)
+    else:
+      self.failures = 0
+      self.schedule(_now)
+
+  def schedule(self, _now): # Next update is due at the offset in the next interval
+    self.due = _now - (_now - self.offset) % INTERVAL + INTERVAL
+
+  @openweather.metrics.timed('update')
+  def update(self, _result = None): # Update Weather data (unless it has already been fetched).
+    if _result is None:
+      _result = openweather.run(openweather.fetch(self.location, self.appid, 'json', self.units, openweather.language()))
+    self.status = _result.status
+    self.error = _result.error
+    self.retry = _result.retry
+    if not self.status:
+      try: 
+        _snapshot = snapshot(_result.data)
+      except (KeyError, IndexError, TypeError, ValueError) as _Error: # Not what we expected
+        self.status = -1
+        self.error = 'Invalid response (' + type(_Error).__name__ + ': ' + str(_Error) + ')'
+    if self.status:
+      if self.status > 0:
+        sys.stderr.write ('Error : ' + str(self.status) + ' - ' + self.error + '\n')
       else:
-        sys.stderr.write ('Error : ' + str(_Error.code) + ' - ' + _Error.reason)
-        self.error = str(_Error.reason)
-      sys.stderr.write ('\n')
-    except Exception:
-      self.status = -1
-      sys.stderr.write (traceback.format_exc())
-      exit(self.status)
+        sys.stderr.write ('Error : ' + self.error + '\n')
+      if hasattr(self, 'weather'): # Keep the previous weather data
+        self.stale = True
+        self.changed = True
+      return
+    _cities[self.key] = _snapshot.city # Can use the city ID next time
+    _history.add(_snapshot)
+    self.description = _snapshot.summary
+    self.weather = _snapshot # Replace the previous data in one go so the display never sees a partial update
+    self.stale = False
+    self.changed = True
+    if _debug: 
+      sys.stderr.write (_snapshot.name + "\n")
+      sys.stderr.write (json.dumps(_result.data, indent=4) + "\n") # Dump dictionary as JSON.
+    self.list()
 
   def list(self): # Print Weather data.
-    import datetime
+    _weather = self.weather
     if _verbose == 1:
-      _output = self.weather['name'].ljust(16)
-      _output += self.weather['weather'][0]['description'].title().ljust(16) + '\t'
-      _output += ' (Icon: ' + self.weather['weather'][0]['icon'] + '.svg'
-      _output += '  Id: ' + str(self.weather['weather'][0]['id']) + self.weather['weather'][0]['icon'][-1:] + ')'
+      _output = _weather.name.ljust(16)
+      _output += _weather.description.ljust(16) + '\t'
+      _output += ' (Icon: ' + _weather.symbol + '.svg'
+      _output += '  Id: ' + _weather.icon + ')'
       _output += '\n'
       sys.stderr.write (_output)
     if _verbose >= 2:
       _output = 'Location : \t\t'
-      _output += self.weather['name'] + '\n'
+      _output += _weather.name + '\n'
       if _verbose >= 3:
         _output += 'Country : \t\t'
-        _output += self.weather['sys']['country'] + '\n'
+        _output += _weather.country + '\n'
         _output += 'Lat/Long : \t\t'
-        _output += '%+06.2f' % float(self.weather['coord']['lat']) + '/' + '%+07.2f' % float(self.weather['coord']['lon']) + '\n'
+        _output += '%+06.2f' % _weather.latitude + '/' + '%+07.2f' % _weather.longitude + '\n'
         _output += 'Sunrise : \t\t' 
-        _output += (datetime.datetime.utcfromtimestamp(self.weather["sys"]["sunrise"]) +  datetime.timedelta(seconds=self.weather["timezone"])).strftime('%Y-%m-%dT%H:%M:%S') + '\n'
+        _output += _weather.local(_weather.sunrise) + '\n'
         _output += 'Sunset : \t\t'
-        _output += (datetime.datetime.utcfromtimestamp(self.weather["sys"]["sunset"]) +  datetime.timedelta(seconds=self.weather["timezone"])).strftime('%Y-%m-%dT%H:%M:%S') + '\n\n'
+        _output += _weather.local(_weather.sunset) + '\n\n'
       _output += 'Description: \t\t'
-      _output += self.weather['weather'][0]['description'].title() + '\n'
+      _output += _weather.description + '\n'
       _output += 'Temperature : \t\t'
-      _output += '%0.f' % round(float(self.weather['main']['temp'])) + ' C\n'
+      _output += '%0.f' % round(_weather.temperature) + ' C\n'
       if _verbose >= 3:
         _output += 'Humidity : \t\t'
-        _output += '%d' % float(self.weather['main']['humidity']) + ' %\n'
+        _output += '%d' % _weather.humidity + ' %\n'
       _output += 'Pressure : \t\t'
-      _output += '%d' % (float(self.weather['main']['pressure'])) + ' mb/hPa\n'
+      _output += '%d' % _weather.pressure + ' mb/hPa\n'
       if _verbose >= 3:
-        if not self.weather['clouds']['all'] is None: # Check cloud data is available
-          _output += 'Cloud Cover : \t\t' + '%d' % (float(self.weather['clouds']['all'])) + ' % '
-          _output += '(' + self.weather['weather'][0]['description'].title() + ')\n'
-        if not self.weather['wind']['speed'] is None: # Check wind speed data is available
-          _output += 'Wind Speed : \t\t' + '%d' % (float(self.weather['wind']['speed']) * 3.6) + ' km/h ' 
+        if not _weather.clouds is None: # Check cloud data is available
+          _output += 'Cloud Cover : \t\t' + '%d' % (float(_weather.clouds)) + ' % '
+          _output += '(' + _weather.description + ')\n'
+        if not _weather.speed is None: # Check wind speed data is available
+          _output += 'Wind Speed : \t\t' + '%d' % (float(_weather.speed) * 3.6) + ' km/h ' 
           _output += '\n'
-        if not self.weather['wind']['deg'] is None: # Check wind direction data is available
-          _output += 'Wind Direction : \t' +  '%d' % float(self.weather['wind']['deg']) + u'\xb0 ' 
+        if not _weather.direction is None: # Check wind direction data is available
+          _output += 'Wind Direction : \t' +  '%d' % float(_weather.direction) + u'\xb0 ' 
         _output += '\n\n'
-        _output += 'Updated : \t\t' + (datetime.datetime.utcfromtimestamp(self.weather["dt"]) +  datetime.timedelta(seconds=self.weather["timezone"])).strftime('%Y-%m-%dT%H:%M:%S') + '\n'
+        _output += 'Updated : \t\t' + _weather.local(_weather.updated) + '\n'
       _output += '\n'
       sys.stderr.write (_output)
 
   def dump(self): # Print Weather data.
-    sys.stderr.write (json.dumps(self.weather, indent=4) + "\n") # Dump dictionary as JSON.
+    sys.stderr.write (json.dumps(self.weather.dict(), indent=4) + "\n") # Dump snapshot as JSON.
 
-  def draw(self, _surface, _position): 
-    import cairosvg
-    def __load_svg(filename, _width):
-      _svg = cairosvg.svg2svg(url = filename, dpi = (96 / (_width / 64))) # Convert svg to svg changing DPI to resize the image
-      _bytes = cairosvg.svg2png(_svg)
-      byte_io = io.BytesIO(_bytes)
-      return pygame.image.load(byte_io)
+  def prepare(self): # Rasterize the icon in the background so it is ready when it is drawn
+    if hasattr(self, 'weather'):
+      try:
+        _render(ICON_FOLDER + self.weather.icon + '.svg', self.width * ICON_SCALE)
+      except OSError: # Will be rendered when it is drawn
+        pass
 
-    #self.size = (self.width, self.height) = (self.width, (self.width + self.width // 6)) # Update size from width
+  def sparkline(self): # Draw the temperature and pressure over the last day (only when there is a new observation)
+    _weather = self.weather
+    if self.trend_key != (_weather.updated, self.width):
+      self.trend_key = (_weather.updated, self.width)
+      self.trend = None
+      _end = _weather.updated + 1
+      _observations = _history.query(_weather.city, _end - TREND_PERIOD, _end) if _history.enabled else None
+      if _observations and len(_observations['time']) > 1:
+        _size = (_width, _height) = (self.width - self.width // 8, self.width // 12)
+        self.trend = pygame.Surface(_size)
+        self.trend.fill(pygame.Color(BACKGROUND_COLOUR))
+        for (_name, _colour) in [('pressure', PRESSURE_COLOUR), ('temperature', TEMPERATURE_COLOUR)]:
+          _points = _resample(_observations['time'], _observations[_name], _end - TREND_PERIOD, _end, _width)
+          if len(_points) > 1:
+            _low = min([_value for (_x, _value) in _points])
+            _range = max([_value for (_x, _value) in _points]) - _low
+            if _range: # Use the full height
+              _points = [(_x, (_height - 1) - int(round((_value - _low) / _range * (_height - 1)))) for (_x, _value) in _points]
+            else: # Draw a line across the middle if the value hasn't changed
+              _points = [(_x, _height // 2) for (_x, _value) in _points]
+            pygame.draw.lines(self.trend, pygame.Color(_colour), False, _points)
+    return self.trend
+
+  @openweather.metrics.timed('draw')
+  def draw(self, _surface, _position): # Draw the icon, only rendering it again if it has changed
+    if self.changed or self.image is None:
+      self.changed = False # Clear this first in case the data changes again while drawing
+      self.render()
+    with openweather.metrics.timer('blit'):
+      return _surface.blit(self.image, _position)
+
+  @openweather.metrics.timed('render')
+  def render(self): 
     _buffer = pygame.Surface((self.width, self.height))
     _buffer.fill(pygame.Color(BACKGROUND_COLOUR))
-    _image = __load_svg('./ico/' + str(self.weather['weather'][0]['id']) + self.weather['weather'][0]['icon'][-1:]+ '.svg', self.width * 0.752)
+    if not hasattr(self, 'weather'): # Just display the location until the weather is available
+      _image = _fonts.render(self.location, self.width // 6, STALE_COLOUR)
+      _buffer.blit(_image, ((self.width - _image.get_width()) // 2, self.width // 24 * 15))
+      self.image = _buffer
+      return
+    _weather = self.weather # Use the same data throughout even if it is updated in the background
+    _colour = STALE_COLOUR if self.stale else DARKTEXT_COLOUR
+    _image = _icons.get(ICON_FOLDER + _weather.icon + '.svg', self.width * ICON_SCALE)
     _left = (self.width - _image.get_width()) // 2
     _top = 0
     _buffer.blit(_image, (_left , _top - self.width // 8)) # Shifting the image up a little is a bit of a fudge but it the top 12 pixels are unused!
     
     _top = self.width // 24 * 15 # Use the icon width to work out how far to move down before displaying the temperature
-    _font=pygame.font.Font(None, self.width // 3 ) # Display temperature in a font half the size of the weather symbol
-    _image = _font.render('%.0f' % round(float(self.weather['main']['temp'])) + 'C', True, pygame.Color(DARKTEXT_COLOUR)) # Display temperature in C
+    _image = _fonts.render(_weather.temperature_text, self.width // 3, _colour) # Display temperature in C in a font half the size of the weather symbol
     _left = (self.width - _image.get_width()) // 2
     _buffer.blit(_image, (_left , _top))
     
     _top += _image.get_height() # Use the previous image height to work out how far to move down before displaying the humidity
-    _font=pygame.font.Font(None, self.width // 6 ) # Display humidity in a font a quarter of the height of the icon
 
-    if _humidity :
-      _image = _font.render(u'(' + ('%d' % float(self.weather['main']['humidity'])) + u'%)', True, pygame.Color(DARKTEXT_COLOUR)) # Display humidity
+    if _humidity : # Display humidity or description in a font a quarter of the height of the icon
+      _image = _fonts.render(_weather.humidity_text, self.width // 6, _colour) # Display humidity
     else:
-      _image = _font.render(self.weather['weather'][0]['description'].title().replace('Intensity ', ''), True, pygame.Color(DARKTEXT_COLOUR)) # Display description
+      _image = _fonts.render(_weather.summary, self.width // 6, _colour) # Display description
     _left = (self.width - _image.get_width()) // 2
     _buffer.blit(_image, (_left , _top))
 
     _top += _image.get_height() # Use the previous image height to work out how far to move down before displaying the location name
-    _font=pygame.font.Font(None, self.width // 6 ) # Display location name in a font a quarter of the height of the icon
-    
-    _image = _font.render(self.weather['name'], True, pygame.Color(DARKTEXT_COLOUR))
+    _image = _fonts.render(_weather.name, self.width // 6, _colour) # Display location name in a font a quarter of the height of the icon
     _left = (self.width - _image.get_width()) // 2
     _buffer.blit(_image, (_left , _top))
 
-    _surface.blit(_buffer, _position)
-    del _buffer
-  
+    _image = self.sparkline() # Display the trends in the space left at the bottom
+    if _image:
+      _buffer.blit(_image, ((self.width - _image.get_width()) // 2, self.height - _image.get_height()))
+
+    self.image = _buffer
+
+
+def _schedule(_items): # Spread the updates out over the update interval
+  _jitter = zlib.crc32(socket.gethostname().encode()) % INTERVAL # Each host uses a different offset
+  _slots = (len(_items) + GROUP_SIZE - 1) // GROUP_SIZE # Locations in the same group are updated together
+  for _index, _item in enumerate(_items):
+    _item.priority = 0 if _index == 0 else 1 # First location is the most important
+    _item.offset = (_jitter + (_index // GROUP_SIZE) * INTERVAL // max(_slots, 1)) % INTERVAL
+
+def _visible(_items): # Skip any locations that can't be found
+  return [_item for _item in _items if not (_item.status in [401, 404] and not hasattr(_item, 'weather'))]
+
+def _capacity(_size): # Number of icons that fit on the display (or a board)
+  _count = 2
+  while _size[0] // _count > ICON_WIDTHS[1] * _size[1] // DISPLAY_HEIGHT: # Check there is space for the icons before adding any more.
+    _count += 1
+  return _count
+
+def _select(_items, _size): # Choose the locations to display
+  return _visible(_items)[:_capacity(_size)]
+
+def _paginate(_items, _size): # Split the locations into pages with the same number of icons on each (or one less)
+  _pages = max((len(_items) + _capacity(_size) - 1) // _capacity(_size), 1)
+  _bounds = [len(_items) * _index // _pages for _index in range(_pages + 1)]
+  return [page(_items[_start:_end], _size) for (_start, _end) in zip(_bounds, _bounds[1:])]
+
+def _layout(_items, _size): # Work out where each icon goes
+  (_width, _height) = _size
+  _positions = []
+  if len(_items) > 0:
+    for _item in _items[:1]: # Position the first icon
+      _item.resize(ICON_WIDTHS[0] * _height // DISPLAY_HEIGHT) # Scale the icons to suit the height of the display
+      _positions.append((_item, (_width // 2 - (_item.width // 2), _height - _item.height - 8 * _height // DISPLAY_HEIGHT)))
+
+    if len(_items) > 1:
+      _offset = (_width // (len(_items) - 1)) // 2
+      for _item in _items[1:]: # Position the icons
+        _item.resize(ICON_WIDTHS[1] * _height // DISPLAY_HEIGHT)
+        _positions.append((_item, ((_offset - _item.width // 2), 8 * _height // DISPLAY_HEIGHT)))
+        _offset += _width // (len(_items) - 1)
+  return _positions
+
+class page(object): # Locations displayed together, drawn on their own surface so the display is updated using a single blit
+
+  def __init__(self, _items, _size):
+    self.items = _items
+    self.size = _size
+    self.positions = _layout(_items, _size) # Icons stay the same size until the pages are laid out again
+    self.surface = None # Only kept while the page is displayed
+
+  @openweather.metrics.timed('page')
+  def render(self, _footer = ()): # Draw the icons that have changed (or everything) and return the areas that have changed
+    _rects = []
+    _all = self.surface is None
+    if _all:
+      self.surface = pygame.Surface(self.size)
+      self.surface.fill(pygame.Color(BACKGROUND_COLOUR))
+      for (_image, _position) in _footer: # IP address and logo
+        self.surface.blit(_image, _position)
+      _rects.append(self.surface.get_rect())
+    for (_item, _position) in self.positions:
+      if _all or _item.changed: # Only draw the icons that have changed
+        _rects.append(_item.draw(self.surface, _position))
+    return _rects
+
+  def release(self): # Free the surface once the page is no longer displayed
+    self.surface = None
+
+def _read_boards(_filename): # Read the boards to draw from a JSON file
+  with open(_filename, encoding = 'utf-8') as _file:
+    _boards = json.load(_file)
+  for _board in _boards: # [{"output": "london.png", "size": [800, 480], "locations": ["London", "Paris"]}, ...]
+    _board['size'] = tuple(_board.get('size') or DISPLAY_SIZE)
+    _board['locations'] = list(collections.OrderedDict([(openweather.normalize(_location), _location) for _location in _board['locations']]).values())
+  return _boards
+
+def _headless(_options): # Prepare a process to draw boards without a display
+  global _humidity, _debug, _verbose
+  (_humidity, _debug, _verbose, _history.enabled) = _options # Set from the command line (which isn't parsed if the process wasn't forked)
+  os.environ['SDL_VIDEODRIVER'] = 'dummy'
+  _pygame().init()
+
+def _draw_board(_path, _size, _items, _previous): # Draw a board and save it as a PNG file if it has changed (in a separate process)
+  _surface = pygame.Surface(_size)
+  _surface.fill(pygame.Color(BACKGROUND_COLOUR))
+  for (_item, _position) in _layout(_items, _size):
+    _item.draw(_surface, _position)
+  _logo = _fonts.render("Source - Open Weather", 16, TEXT_COLOUR)
+  _surface.blit(_logo, (_size[0] - _logo.get_width() - 2, _size[1] - _logo.get_height()))
+  _hash = hashlib.sha1(pygame.image.tostring(_surface, 'RGB')).hexdigest()
+  if _previous is None and os.path.exists(_path): # Compare it with the file saved last time
+    try:
+      _previous = hashlib.sha1(pygame.image.tostring(pygame.image.load(_path), 'RGB')).hexdigest()
+    except pygame.error:
+      pass
+  if _hash == _previous and os.path.exists(_path):
+    return _hash, False
+  (_name, _extension) = os.path.splitext(_path)
+  _temp = _name + '.' + str(os.getpid()) + _extension # Write to a temporary file first so a partial file is never used
+  pygame.image.save(_surface, _temp)
+  os.replace(_temp, _path)
+  return _hash, True
+
+
 if __name__ == '__main__': 
   
   def _about():
@@ -247,12 +907,29 @@ if __name__ == '__main__':
       "Usage: " + sys.argv[0] + " [LOCATION]...\n" +
       "Display weather conditions at LOCATION(s).\n" + "\n" +
       "      --appid <key>        specify the API key \n" +
+      "      --base-url <url>     use a different server \n" +
+      "      --boards <file>      save the boards in file (JSON) as PNG files \n" +
+      "                           instead of using the display \n" +
+      "      --once               save the boards once and exit \n" +
+      "      --jobs <n>           fetch up to n locations at the same time \n" +
+      "      --near <lat,lon>     display weather at the nearest city in the index \n" +
+      "      --nocache            do not use cached responses \n" +
+      "      --noindex            do not look up locations in the city index \n" +
+      "      --nohistory          do not keep a history of the weather \n" +
+      "      --page-time <n>      display each page of locations for n seconds \n" +
+      "      --rate <n>           send no more than n requests a minute \n" +
+      "      --locations-file <f> read locations from file f ('-' for stdin) \n" +
+      "      --metrics <port>     serve timings and counters (Prometheus format) \n" +
+      "                           on port \n" +
+      "      --profile <file>     profile the run and write the results to file \n" +
+      "                           (cProfile if it ends in .prof or sampled stacks) \n" +
       "      --noip               do not display IP address \n" +
       "      --nologo             do not display OpenWeather logo \n" +
       "      --verbose            Displays increasingly verbose output \n" +
       "  -?, --help               display this help and exit\n" +
       "      --version            output version information and exit\n" +
       "      --debug              dump raw data as JSON\n" +
+      "      --prerender          render all the icons to the cache and exit\n" +
       "\nExample:\n" +
       "  " + os.path.basename(sys.argv[0]) + " London display weather in London.\n")
     raise SystemExit
@@ -268,6 +945,18 @@ if __name__ == '__main__':
     sys.stderr.write(os.path.basename(sys.argv[0]) + ": " + _error + "\n")
     raise SystemExit
 
+  def _nearest(_position): # Nearest city in the index to 'latitude,longitude'
+    try:
+      (_latitude, _longitude) = [float(_value) for _value in _position.split(',')]
+    except ValueError:
+      _error ("invalid position -- '" + _position + "'")
+    if not -90 <= _latitude <= 90 or not -180 <= _longitude <= 180:
+      _error ("invalid position -- '" + _position + "'")
+    _places = openweather.cities.near(_latitude, _longitude)
+    if not _places:
+      _error ("city index not found (use py-weather.py --build-index)")
+    return '#' + str(_places[0][1].id) # City ID
+
   def _get_address():
     import socket
     try: # Attempt to get the IP address
@@ -279,23 +968,120 @@ if __name__ == '__main__':
       _address = ''
     return _address
 
-  def _scan():
-    event = pygame.event.poll() # Will return NOEVENT if there are no events in the queue.
+  def _quit():
+    if _verbose:
+      sys.stderr.write (_icons.stats())
+      sys.stderr.write (_fonts.stats())
+      sys.stderr.write (openweather.cache.stats())
+      sys.stderr.write (_history.stats())
+      sys.stderr.write (openweather.pool.stats())
+      sys.stderr.write (openweather.limit.stats())
+      _output = 'Wakeups : \t\t' + str(_wakeups) + ' (' + '%.3f' % (_wakeups / max(time.time() - _start, 1)) + '/s)\n'
+      _output += 'Frames : \t\t' + str(_frames)
+      if _frames:
+        _output += ' (Average: ' + '%.2f' % (_frame_time * 1000 / _frames) + ' ms  Max: ' + '%.2f' % (_frame_max * 1000) + ' ms)'
+      sys.stderr.write (_output + '\n')
+      sys.stderr.write (openweather.metrics.summary())
+    pygame.quit()
+    sys.exit()
+
+  def _publish(_boards): # Save each board as a PNG file whenever the weather changes
+    global _drawn, _saved, _failures
+    import concurrent.futures
+    _items = collections.OrderedDict() # Weather for each location (only fetched once however many boards it is on)
+    for _board in _boards:
+      for _location in _board['locations']:
+        _items.setdefault(openweather.normalize(_location), weather(ICON_WIDTHS[1], _location, _appid, _update = False))
+    _schedule(list(_items.values()))
+    _load_cities()
+    _hashes = {} # Hash of each board that has been saved
+    with concurrent.futures.ProcessPoolExecutor(initializer = _headless, initargs = ((_humidity, _debug, _verbose, _history.enabled),)) as _processes:
+      while True:
+        _now = time.time()
+        _due = [_item for _item in _items.values() if _item.due <= _now]
+        try:
+          if _due:
+            _update(_due, _jobs)
+            _failures += len([_item for _item in _due if _item.status])
+            _changed = set([_item.key for _item in _due])
+            _drawing = []
+            for _board in _boards:
+              _keys = [openweather.normalize(_location) for _location in _board['locations']]
+              if _changed.intersection(_keys): # Only draw the boards that include a location that has been updated
+                _weather = _select([_items[_key] for _key in _keys], _board['size'])
+                if not _weather or not all([hasattr(_item, 'weather') for _item in _weather]): # Keep the last board saved until there is weather for every icon (even if out of date)
+                  sys.stderr.write ('Error : ' + _board['output'] + ' not saved (weather not available)\n')
+                  _failures += 1
+                  continue
+                _drawing.append((_board['output'], _processes.submit(_draw_board, _board['output'], _board['size'], _weather, _hashes.get(_board['output']))))
+            for (_output, _job) in _drawing:
+              (_hashes[_output], _written) = _job.result()
+              _drawn += 1
+              _saved += _written
+          _next = min([_item.due for _item in _items.values()] or [_now + INTERVAL])
+        except Exception: # Keep going (and try again later) whatever goes wrong
+          sys.stderr.write (traceback.format_exc())
+          _failures += 1
+          _next = _now + RETRY
+        if _once:
+          return
+        time.sleep(max(0, _next - time.time()))
+
+  def _refresh(): # Update the weather in the background
+    global _weather
+    _load_cities()
+    while True:
+      _now = time.time()
+      _due = [_item for _item in _weather if _item.due <= _now]
+      try:
+        if _due:
+          _update(_due, _jobs) # Update the weather for every location that is due at the same time
+          for _item in _due:
+            _item.prepare()
+          _selected = _visible(_items)
+          if _selected != _weather: # Some locations couldn't be found so lay out the pages again without them
+            _weather = _selected
+            pygame.event.post(pygame.event.Event(LAYOUT_EVENT))
+          else:
+            pygame.event.post(pygame.event.Event(UPDATE_EVENT)) # Wake up the display
+        _next = min([_item.due for _item in _weather] or [_now + INTERVAL])
+      except Exception: # Otherwise the thread stops and the weather is never updated again
+        sys.stderr.write (traceback.format_exc())
+        _next = _now + RETRY
+      time.sleep(max(0, _next - time.time()))
+
+  @openweather.metrics.timed('event') # Includes the time spent waiting
+  def _scan(_wait):
+    global _redraw, _turn, _wakeups
+    if _wait:
+      try:
+        event = pygame.event.wait(WAIT_TIME) # Sleep until something happens (returns NOEVENT after a while so Ctrl-C works)
+      except TypeError: # Older versions of pygame can't wait with a timeout so use a timer instead
+        pygame.time.set_timer(UPDATE_EVENT, WAIT_TIME)
+        event = pygame.event.wait()
+        pygame.time.set_timer(UPDATE_EVENT, 0)
+    else:
+      event = pygame.event.poll() # Will return NOEVENT if there are no events in the queue.
+    _wakeups += 1
     if event.type == pygame.QUIT:
-      pygame.quit()
-      sys.exit()
+      _quit()
     elif event.type == pygame.KEYDOWN:
       if event.key == pygame.K_ESCAPE:
-        pygame.quit()
-        sys.exit()
+        _quit()
       elif event.key == pygame.K_SPACE:
         return False
+      elif event.key == pygame.K_RIGHT:
+        _turn = True # Show the next page now
     elif event.type == pygame.MOUSEBUTTONUP:
       #sys.stderr.write (str(pygame.mouse.get_pos()) + '\n')
       return False
     elif event.type == pygame.MOUSEBUTTONDOWN:
       #sys.stderr.write (str(pygame.mouse.get_pos()) + '\n')
       pass
+    elif event.type in [pygame.VIDEOEXPOSE, LAYOUT_EVENT]:
+      _redraw = True # Contents of the window have been lost or the icons have moved
+    elif event.type == PAGE_EVENT:
+      _turn = True # Time to scroll to the next page
     return True
 
   try:      
@@ -304,6 +1090,15 @@ if __name__ == '__main__':
     _showlogo = True
     _humidity = False
     _verbose = 0
+    _prerender_only = False
+    _board_file = None
+    _once = False
+    _jobs = JOBS
+    _port = None
+    _profile = None
+    _page_time = PAGE_TIME
+
+    openweather.limit.set(RATE_LIMIT, BURST) # Unless changed using '--rate'
 
     _locations = []
     _count = 1
@@ -321,10 +1116,74 @@ if __name__ == '__main__':
           _debug = True
         elif _arg in ["--humidity"]:
           _humidity = True
+        elif _arg in ["--base-url"]:
+          if _count + 1 < len(sys.argv):
+            openweather.API = sys.argv[_count + 1].rstrip('/') + '/'
+            _count += 1
+          else:
+            _error ("base URL not specified")
+        elif _arg in ["--locations-file"]:
+          if _count + 1 < len(sys.argv) and (sys.argv[_count + 1] == "-" or os.path.isfile(sys.argv[_count + 1])):
+            _locations.extend(openweather.read(sys.argv[_count + 1]))
+            _count += 1
+          else:
+            _error ("locations file not found")
+        elif _arg in ["--rate"]:
+          if _count + 1 < len(sys.argv) and sys.argv[_count + 1].isdigit() and int(sys.argv[_count + 1]) > 0:
+            openweather.limit.set(int(sys.argv[_count + 1]))
+            _count += 1
+          else:
+            _error ("invalid rate")
+        elif _arg in ["--jobs"]:
+          if _count + 1 < len(sys.argv) and sys.argv[_count + 1].isdigit() and int(sys.argv[_count + 1]) > 0:
+            _jobs = int(sys.argv[_count + 1])
+            _count += 1
+          else:
+            _error ("invalid number of jobs")
+        elif _arg in ["--page-time"]:
+          if _count + 1 < len(sys.argv) and sys.argv[_count + 1].isdigit() and int(sys.argv[_count + 1]) > 0:
+            _page_time = int(sys.argv[_count + 1])
+            _count += 1
+          else:
+            _error ("invalid page time")
+        elif _arg in ["--metrics"]:
+          if _count + 1 < len(sys.argv) and sys.argv[_count + 1].isdigit():
+            _port = int(sys.argv[_count + 1])
+            _count += 1
+          else:
+            _error ("invalid port")
+        elif _arg in ["--profile"]:
+          if _count + 1 < len(sys.argv):
+            _profile = sys.argv[_count + 1]
+            _count += 1
+          else:
+            _error ("profile not specified")
+        elif _arg in ["--prerender"]:
+          _prerender_only = True
+        elif _arg in ["--boards"]:
+          if _count + 1 < len(sys.argv) and os.path.isfile(sys.argv[_count + 1]):
+            _board_file = sys.argv[_count + 1]
+            _count += 1
+          else:
+            _error ("boards file not found")
+        elif _arg in ["--once"]:
+          _once = True
         elif _arg in ["--noip"]:
           _showip = False
         elif _arg in ["--nologo"]:
           _showlogo = False
+        elif _arg in ["--nocache"]:
+          openweather.cache.enabled = False
+        elif _arg in ["--near"]:
+          if _count + 1 < len(sys.argv):
+            _locations.append(_nearest(sys.argv[_count + 1]))
+            _count += 1
+          else:
+            _error ("position not specified")
+        elif _arg in ["--noindex"]:
+          openweather.cities.enabled = False
+        elif _arg in ["--nohistory"]:
+          _history.enabled = False
         elif _arg in "--appid":
           if _count < len(sys.argv):
             if sys.argv[_count + 1][:1] != "-":
@@ -336,30 +1195,62 @@ if __name__ == '__main__':
           else:
             _error ("invalid option -- '" + (_arg[1:] + "'"))
       else:
-        _locations.append(_arg)
+        _locations.extend(openweather.read(_arg) if _arg == "-" else [_arg])
       _count += 1
 
+    if _prerender_only:
+      _count = _prerender()
+      if _verbose:
+        sys.stderr.write ('Rendered : \t\t' + str(_count) + ' icons (' + ICON_CACHE + ')\n')
+      raise SystemExit
+
     if _appid == "":
       _error ("APPID not specified")
 
-    _weather = []
+    if _profile:
+      import atexit
+      _profiler = openweather.profiler(_profile)
+      _profiler.start()
+      atexit.register(_profiler.stop) # Write the profile however it exits
+
+    if _port is not None:
+      openweather.metrics.add(lambda: collections.OrderedDict([('icon_hits_total', _icons.hits), ('icon_misses_total', _icons.misses),
+                                                               ('text_hits_total', _fonts.hits), ('text_misses_total', _fonts.misses)]))
+      openweather.metrics.serve(_port)
+
+    if _board_file:
+      try:
+        _boards = _read_boards(_board_file)
+      except (OSError, ValueError, KeyError, TypeError):
+        _error ("invalid boards file")
+      _drawn = 0
+      _saved = 0
+      _failures = 0 # Updates that failed and boards that couldn't be drawn
+      _publish(_boards)
+      if _verbose:
+        sys.stderr.write (openweather.cache.stats())
+        sys.stderr.write (_history.stats())
+        sys.stderr.write (openweather.pool.stats())
+        sys.stderr.write ('Boards : \t\t' + 'Drawn: ' + str(_drawn) + '  Saved: ' + str(_saved) + '  Failed: ' + str(_failures) + '\n')
+        sys.stderr.write (openweather.metrics.summary()) # Doesn't include drawing the boards (done in other processes)
+      raise SystemExit(1 if _failures else 0) # Only returns when '--once' is used (so cron can tell if it failed)
 
-    for _location in _locations[:1]:
-      _item = weather(288, _location, _appid) # Get the weather for the location (left, top, width, height)
-      if not _item.status: # Only add it to the list of weather results if successful
-        _weather.append(_item) 
+    _unique = collections.OrderedDict()
+    for _location in _locations:
+      _unique.setdefault(openweather.normalize(_location), _location) # Only display each location once
+    _locations = list(_unique.values())
 
-    for _location in _locations[1:]:
-      _item = weather(96, _location, _appid) # Get the weather for the location (left, top, width, height)
-      if not _item.status: # Only add it to the list of weather results if successful
-        if len(_weather) < 2: # Two icons should be no problem but 
-          _weather.append(_item) 
-        elif ((DISPLAY_SIZE)[0] // len(_weather) > 96): # Check there is space for the icons before adding any more.
-          _weather.append(_item) 
+    _widths = [ICON_WIDTHS[0]] + [ICON_WIDTHS[1]] * (len(_locations) - 1)
+    _items = [weather(_width, _location, _appid, _update = False) for (_width, _location) in zip(_widths, _locations)] # Keep the same order as the locations
 
+    _schedule(_items)
+    _weather = _visible(_items) # Weather is fetched in the background once the display is open
+
+    _pygame()
     pygame.init() 
     pygame.font.init()
     pygame.mouse.set_visible(False)
+    pygame.event.set_blocked(pygame.MOUSEMOTION) # Don't wake up every time the mouse moves
 
     _icon = pygame.Surface((32, 32)) # Create a blank icon (32 x 32) for the window
     _icon.fill(pygame.Color('black')) 
@@ -369,46 +1260,95 @@ if __name__ == '__main__':
 
     _screen = pygame.display.set_mode((DISPLAY_SIZE))
     _screen.fill(pygame.Color('black'))
-    _background = pygame.Surface((DISPLAY_SIZE)) # Create a drawing surface for the background    
-    _background.fill(pygame.Color(BACKGROUND_COLOUR))
+    _size = (_width, _height) = _screen.get_size()
+    _strip = pygame.Surface((_width * 2, _height)) # Current and next page side by side while scrolling
       
-    _font=pygame.font.Font(None, 16)
-    _address = _font.render(_get_address(), True, pygame.Color(TEXT_COLOUR))
-    _logo = _font.render("Source - Open Weather", True, pygame.Color(TEXT_COLOUR))
+    _address = _fonts.render(_get_address(), 16, TEXT_COLOUR)
+    _logo = _fonts.render("Source - Open Weather", 16, TEXT_COLOUR)
+    _footer = [] # Drawn at the bottom of every page
+    if (_showip):
+      _footer.append((_address, (2, _height - _address.get_height()))) # Display the IP address 
+    if (_showlogo):
+      _footer.append((_logo, (_width -_logo.get_width() - 2, _height - _logo.get_height()))) # Display the logo
 
-    _now = time.time()
-    _time = (_now - _now % INTERVAL) + INTERVAL
-    
-    while _scan(): # Wait for an event.
-
-      _screen.blit(_background, (0, 0)) # Redrawing the background every time the display is updated fixes the transparency issue 
-      if (_showip):
-        _screen.blit(_address, (2, _screen.get_height() - _address.get_height())) # Display the IP address 
-      if (_showlogo):
-        _screen.blit(_logo, (_screen.get_width() -_logo.get_width() - 2, _screen.get_height() - _logo.get_height())) # Display the logo
-
-      if len(_weather) > 0:
-        _offset = _screen.get_width() // 2
-        for _item in _weather[:1]: # Draw the first icon
-          _item.width = 288
-          _item.draw(_screen, (_offset - (_item.width // 2), 136))
-
-        if len(_weather) > 1:
-          _offset = (_screen.get_width() // (len(_weather) - 1)) // 2
-          for _item in _weather[1:]: # Draw the icons
-            _item.width = 96
-            _item.draw(_screen, ((_offset - _item.width // 2), 8))        
-            _offset += _screen.get_width() // (len(_weather) - 1)
-          
-      _now = time.time()
-      
-      if _time -_now <= 0:
-        _time = (_now - _now % INTERVAL) + INTERVAL
-        for _item in _weather: # Update the weather
-          _item.update()
+    UPDATE_EVENT = pygame.USEREVENT # Posted when the weather has been updated
+    LAYOUT_EVENT = pygame.USEREVENT + 1 # Posted when the locations displayed have changed
+    PAGE_EVENT = pygame.USEREVENT + 2 # Posted when it is time to display the next page
+    threading.Thread(target = _refresh, daemon = True).start()
+
+    _redraw = True # Draw everything the first time around
+    _shown = None # Locations on the pages
+    _pages = []
+    _page = 0 # Page being displayed
+    _turn = False # Set when it is time to scroll to the next page
+    _scrolling = None # Time it started scrolling
+    _clock = pygame.time.Clock()
+    _start = time.time()
+    _wakeups = 0
+    _frames = 0
+    _frame_time = 0
+    _frame_max = 0
+    openweather.metrics.add(lambda: collections.OrderedDict([('frames_total', _frames), ('wakeups_total', _wakeups)]))
+    while _scan(not (_redraw or _turn or _scrolling is not None)): # Wait for an event (or the weather to be updated) unless scrolling.
+
+      _frame = time.time()
+      _rects = [] # Areas of the display that have changed
+      if _weather is not _shown: # Locations have changed so lay out the pages again
+        _shown = _weather
+        _pages = _paginate(_weather, _size)
+        _page = _page % len(_pages)
+        _scrolling = None
+        _redraw = True
+        pygame.time.set_timer(PAGE_EVENT, _page_time * 1000 if len(_pages) > 1 else 0) # Only rotate if there is more than one page
+
+      if _turn: # Start scrolling to the next page
+        _turn = False
+        if _scrolling is None and len(_pages) > 1:
+          _next = (_page + 1) % len(_pages)
+          _pages[_page].render(_footer)
+          _pages[_next].render(_footer) # Bring the next page up to date before it is displayed
+          with openweather.metrics.timer('blit'):
+            _strip.blit(_pages[_page].surface, (0, 0))
+            _strip.blit(_pages[_next].surface, (_width, 0))
+          _scrolling = time.time()
+
+      if _scrolling is not None:
+        _progress = (time.time() - _scrolling) / SCROLL_TIME
+        if _progress < 1:
+          _offset = int(_width * _progress * _progress * (3 - 2 * _progress)) # Ease in and out
+          with openweather.metrics.timer('blit'):
+            _screen.blit(_strip, (0, 0), pygame.Rect(_offset, 0, _width, _height)) # One blit for each frame
+          _rects.append(_screen.get_rect())
+        else:
+          _pages[_page].release() # Only keep the page that is displayed
+          _page = (_page + 1) % len(_pages)
+          _scrolling = None
+          _redraw = True
+
+      if _scrolling is None:
+        _changed = _pages[_page].render(_footer) # Draw any icons that have changed on the page
+        if _redraw or _changed:
+          with openweather.metrics.timer('blit'):
+            _screen.blit(_pages[_page].surface, (0, 0))
+          _rects.extend([_screen.get_rect()] if _redraw else _changed)
+        _redraw = False
 
-      pygame.display.flip()
-      pygame.time.Clock().tick(FPS)
+      if _rects:
+        with openweather.metrics.timer('flip'):
+          pygame.display.update(_rects) # Nothing to do if nothing has changed
+        _frames += 1
+        _frame = time.time() - _frame
+        openweather.metrics.observe('frame', _frame)
+        _frame_time += _frame
+        _frame_max = max(_frame_max, _frame)
+        if _frames == 1:
+          _first = time.perf_counter() - _started
+          if _verbose:
+            sys.stderr.write ('First frame : \t\t' + '%.1f' % (_first * 1000) + ' ms\n')
+          if _debug:
+            sys.stderr.write (startup.modules.report())
+        _clock.tick(FPS) # Limit the frame rate
+    _quit()
 
   except KeyboardInterrupt: # Ctrl-C
     pass
@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+#
+#-- py-weather-benchmark.py
+#
+#   Measures  how long it takes to fetch and display the weather using  the
+#   local test server (py-weather-server.py) so no API key is needed.
+#
+#   Requires:           python3, python3-pygame, python3-cairosvg
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under  the terms of the GNU General Public License as published by  the
+#   Free Software Foundation, either version 3 of the License, or (at  your
+#   option) any later version.
+#
+#   This  program is distributed in the hope that it will  be  useful,  but
+#   WITHOUT   ANY   WARRANTY;   without even  the   implied   warranty   of
+#   MERCHANTABILITY  or  FITNESS  FOR A PARTICULAR  PURPOSE.  See  the  GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   18 Oct 26   0.1   - Initial version - MT
+#                     - Reports the number of locations fetched per second,
+#                       the latency of each request, the time taken to run
+#                       py-weather.py and the time taken to draw each frame
+#                       for different numbers of locations - MT
+#                     - Also  reports the time taken to draw each frame  if
+#                       fonts and text are not cached - MT
+#                     - Reports the time taken for py-weather.py to write
+#                       the first line and for py-pygame-weather.py to draw
+#                       the first frame - MT
+#                     - Uses openweather.py to fetch the weather - MT
+#                     - Reports how quickly each parser converts responses
+#                       (recorded from the server or read from the cache
+#                       using '--responses') - MT
+#                     - Half the responses from the test server are sent in
+#                       chunks - MT
+#                     - Uses a temporary cache folder (apart from the icons)
+#                       so made up weather isn't added to the history - MT
+#
+VERSION = "0.1"
+
+COUNTS = [1, 10, 100, 500] # Numbers of locations to test
+FRAMES = 30 # Number of frames to draw for each test
+PASSES = 5 # Number of times to parse the responses (the quickest is used)
+JOBS = 8
+CHUNKED = 0.5 # Fraction of responses the test server sends in chunks
+
+import os, sys, time, subprocess, asyncio
+import importlib.util, builtins, tempfile, shutil
+
+ICONS = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'py-weather', 'icons') # Rendered icons (the only part of the user's cache used)
+CACHE = tempfile.mkdtemp(prefix = 'py-weather-benchmark.') # Made up weather and city IDs are kept here (and removed afterwards)
+os.environ['XDG_CACHE_HOME'] = CACHE # Used by both scripts (and openweather.py)
+os.makedirs(os.path.join(CACHE, 'py-weather'))
+if os.path.isdir(ICONS):
+  os.symlink(ICONS, os.path.join(CACHE, 'py-weather', 'icons'))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))) # Find openweather.py
+import openweather
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load(_name): # Load one of the scripts as a module
+  _print = builtins.print # Loading py-pygame-weather.py replaces print()
+  _spec = importlib.util.spec_from_file_location(_name.replace('-', '_')[:-3], os.path.join(FOLDER, _name))
+  _module = importlib.util.module_from_spec(_spec)
+  _spec.loader.exec_module(_module)
+  builtins.print = _print
+  _module._debug = False # Normally set when parsing the command line
+  _module._verbose = 0
+  _module._humidity = False
+  openweather.API = _api
+  openweather.cache.enabled = False # Always fetch the data from the server
+  return _module
+
+def _percentile(_values, _percent):
+  _values = sorted(_values)
+  if not _values:
+    return 0
+  return _values[min(len(_values) - 1, int(len(_values) * _percent / 100))]
+
+def _ms(_seconds):
+  return '%9.2f' % (_seconds * 1000)
+
+def _locations(_count):
+  return ['Location ' + str(_index) for _index in range(_count)]
+
+def _fetch(_count): # Fetch the weather for each location (as py-weather.py does)
+  _module = _load('py-weather.py')
+  _times = []
+  async def _timed(_semaphore, _location):
+    async with _semaphore:
+      _start = time.time()
+      _result = await openweather.fetch(_location, 'benchmark', 'xml')
+      _times.append(time.time() - _start)
+      return _module.weather(_location, 'benchmark', _result)
+  async def _all():
+    _semaphore = asyncio.Semaphore(_jobs)
+    return await asyncio.gather(*[_timed(_semaphore, _location) for _location in _locations(_count)])
+  _start = time.time()
+  _items = openweather.run(_all())
+  _total = time.time() - _start
+  _errors = len([_item for _item in _items if _item.status])
+  sys.stdout.write ('%9d' % _count + '%12.1f' % (_count / _total) + _ms(_percentile(_times, 50)) +
+                    _ms(_percentile(_times, 90)) + _ms(_percentile(_times, 99)) + '%9d' % _errors + '\n')
+
+def _command(_count): # Time py-weather.py until the first line is written and from start to finish
+  _start = time.time()
+  _process = subprocess.Popen([sys.executable, os.path.join(FOLDER, 'py-weather.py'), '--nocache', '--base-url',
+                               _api, '--appid', 'benchmark', '--jobs', str(_jobs)] + _locations(_count), stdout = subprocess.PIPE)
+  _process.stdout.readline()
+  _first = time.time() - _start
+  _process.stdout.read()
+  _process.wait()
+  sys.stdout.write ('%9d' % _count + _ms(_first) + '     ' + _ms(time.time() - _start) + '\n')
+
+def _display(_count): # Time py-pygame-weather.py until the first frame has been drawn
+  _start = time.time()
+  _process = subprocess.Popen([sys.executable, os.path.join(FOLDER, 'py-pygame-weather.py'), '--nocache', '--nohistory', '--verbose', '--rate', '1000000',
+                               '--base-url', _api, '--appid', 'benchmark'] + _locations(_count), cwd = FOLDER, stderr = subprocess.PIPE,
+                               universal_newlines = True)
+  _first = None
+  for _line in _process.stderr:
+    if _line.startswith('First frame'):
+      _first = time.time() - _start
+      break
+  _process.terminate()
+  _process.communicate()
+  sys.stdout.write ('%9d' % _count + (_ms(_first) if _first is not None else '        -') + '\n')
+
+def _render(_count, _pygame): # Draw all the icons (as if they had all changed) and time each frame
+  _module = _load('py-pygame-weather.py')
+  _module._pygame()
+  _module._history.enabled = False # Don't add made up weather to the history
+  _items = [_module.weather(_module.ICON_WIDTHS[1], _location, 'benchmark', _update = False) for _location in _locations(_count)]
+  _module._update(_items, _jobs)
+  _items = [_item for _item in _items if not _item.status]
+  _surface = _pygame.Surface((_module.DISPLAY_WIDTH, _module.DISPLAY_HEIGHT))
+  def _draw(_cached):
+    _times = []
+    for _frame in range(_frames):
+      if not _cached: # Load fonts and render text every time
+        _module._fonts.clear()
+      _start = time.time()
+      for _item in _items:
+        _item.changed = True
+        _item.draw(_surface, (0, 0))
+      _times.append(time.time() - _start)
+    return _times
+  _times = _draw(True)
+  _uncached = _draw(False)
+  sys.stdout.write ('%9d' % _count + _ms(_times[0]) + _ms(sum(_times[1:]) / max(len(_times) - 1, 1)) +
+                    _ms(_percentile(_times[1:], 99)) + _ms(sum(_uncached) / len(_uncached)) + '\n')
+
+def _record(_count): # Get responses (as XML and JSON) from the server
+  async def _get(_location, _mode):
+    return (await openweather.pool.get(openweather.API + 'weather?units=metric' + _mode + '&q=' + _location.replace(' ', '+') + '&appid=benchmark'))[1]
+  async def _all():
+    return [await _get(_location, _mode) for _location in _locations(_count) for _mode in ['&mode=xml', '']]
+  return openweather.run(_all())
+
+def _recorded(_filename): # Get the responses kept in a cache (responses.sqlite)
+  import sqlite3
+  _connection = sqlite3.connect('file:' + _filename + '?mode=ro', uri = True)
+  try:
+    return [bytes(_row[0]) for _row in _connection.execute('SELECT data FROM responses')]
+  finally:
+    _connection.close()
+
+def _parse(_responses): # Time how long each parser takes for each response
+  _module = _load('py-weather.py')
+  _xml = [_data for _data in _responses if _data.lstrip()[:1] == b'<']
+  _json = [_data for _data in _responses if _data.lstrip()[:1] == b'{']
+  _parsers = []
+  try:
+    import xmltodict
+    _parsers.append(('xml', 'xmltodict', xmltodict.parse, _xml))
+  except ImportError:
+    pass
+  _parsers.append(('xml', 'expat', lambda _data: openweather.elements(_data, _module.FIELDS), _xml))
+  for _name in openweather.JSON_PARSERS:
+    try:
+      _parsers.append(('json', _name, openweather.parser([_name])[1], _json))
+    except ImportError: # Not installed
+      pass
+  for (_format, _name, _function, _data) in _parsers:
+    if _data:
+      _best = None
+      for _pass in range(_passes):
+        _start = time.perf_counter()
+        for _item in _data:
+          _function(_item)
+        _time = time.perf_counter() - _start
+        _best = _time if _best is None else min(_best, _time)
+      sys.stdout.write (_format.ljust(7) + _name.ljust(12) + '%9d' % len(_data) + '%11.1f' % (_best / len(_data) * 1e6) +
+                        '%12d' % (len(_data) / max(_best, 1e-9)) + '\n')
+
+def _server(_latency): # Start the test server and return its URL
+  _process = subprocess.Popen([sys.executable, os.path.join(FOLDER, 'py-weather-server.py'), '--port', '0',
+                               '--latency', str(_latency), '--chunked', str(CHUNKED)], stdout = subprocess.PIPE, universal_newlines = True)
+  return _process, _process.stdout.readline().strip()
+
+if __name__ == '__main__':
+
+  def _about():
+    sys.stdout.write(
+      "Usage: " + sys.argv[0] + " [OPTION]...\n" +
+      "Measure how quickly the weather can be fetched and displayed.\n" + "\n" +
+      "      --base-url <url>     use this server instead of starting one \n" +
+      "      --counts <list>      numbers of locations (default " + ','.join([str(_count) for _count in COUNTS]) + ") \n" +
+      "      --frames <n>         number of frames to draw for each test \n" +
+      "      --jobs <n>           fetch up to n locations at the same time \n" +
+      "      --latency <ms>       delay added by the test server \n" +
+      "      --norender           do not measure drawing \n" +
+      "      --passes <n>         number of times to parse the responses \n" +
+      "      --responses <file>   parse the responses in a cache (responses.sqlite) \n" +
+      "                           instead of recording them from the server \n" +
+      "  -?, --help               display this help and exit\n" +
+      "      --version            output version information and exit\n" +
+      "\nExample:\n" +
+      "  " + os.path.basename(sys.argv[0]) + " --counts 1,20 --latency 50\n")
+    raise SystemExit
+
+  def _version():
+    sys.stdout.write(os.path.basename(sys.argv[0]) + " " + str(VERSION) +"\n"
+      "License GPLv3+: GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.\n"
+      "This is free software: you are free to change and redistribute it.\n"
+      "There is NO WARRANTY, to the extent permitted by law.\n")
+    raise SystemExit
+
+  def _error(_error):
+    sys.stderr.write(os.path.basename(sys.argv[0]) + ": " + _error + "\n")
+    raise SystemExit
+
+  def _value(_count, _convert): # Get the value for an option
+    try:
+      return _convert(sys.argv[_count + 1])
+    except (IndexError, ValueError):
+      _error ("invalid value for option -- '" + sys.argv[_count][2:] + "'")
+
+  _process = None
+  try:
+    _api = None
+    _counts = COUNTS
+    _frames = FRAMES
+    _jobs = JOBS
+    _latency = 0
+    _rendering = True
+    _passes = PASSES
+    _responses = None
+
+    _count = 1
+    while _count < len(sys.argv):
+      _arg = sys.argv [_count]
+      if _arg in ["--help", "-?"]:
+        _about()
+      elif _arg in ["--version"]:
+        _version()
+      elif _arg in ["--base-url"]:
+        _api = _value(_count, lambda _url: _url.rstrip('/') + '/')
+        _count += 1
+      elif _arg in ["--counts"]:
+        _counts = _value(_count, lambda _list: [int(_item) for _item in _list.split(',')])
+        _count += 1
+      elif _arg in ["--frames"]:
+        _frames = max(2, _value(_count, int))
+        _count += 1
+      elif _arg in ["--jobs"]:
+        _jobs = max(1, _value(_count, int))
+        _count += 1
+      elif _arg in ["--latency"]:
+        _latency = _value(_count, float)
+        _count += 1
+      elif _arg in ["--norender"]:
+        _rendering = False
+      elif _arg in ["--passes"]:
+        _passes = max(1, _value(_count, int))
+        _count += 1
+      elif _arg in ["--responses"]:
+        _responses = _value(_count, str)
+        if not os.path.isfile(_responses):
+          _error ("responses not found -- '" + _responses + "'")
+        _count += 1
+      elif _arg[:2] == "--":
+        _error ("unrecognized option -- '" + (_arg[1:] + "'"))
+      else:
+        _error ("invalid option -- '" + (_arg[1:] + "'"))
+      _count += 1
+
+    if _api is None:
+      (_process, _api) = _server(_latency)
+
+    sys.stdout.write ('Fetch' + '\n' + 'Locations  Fetched/s  p50 (ms)  p90 (ms)  p99 (ms)   Errors\n')
+    for _count in _counts:
+      _fetch(_count)
+
+    sys.stdout.write ('\n' + 'py-weather.py' + '\n' + 'Locations First line (ms)  Time (ms)\n')
+    for _count in _counts:
+      _command(_count)
+
+    sys.stdout.write ('\n' + 'Parse' + '\n' + 'Format Parser      Responses  Each (us)    Parsed/s\n')
+    _load('py-weather.py') # Set up openweather.py to use the server
+    _parse(_recorded(_responses) if _responses else _record(max(_counts)))
+
+    if _rendering:
+      os.environ.setdefault('SDL_VIDEODRIVER', 'dummy') # Don't need a display
+      pygame = _load('py-pygame-weather.py')._pygame() # Imported without printing the banner
+      pygame.init()
+      sys.stdout.write ('\n' + 'py-pygame-weather.py' + '\n' + 'Locations First pixel (ms)\n')
+      for _count in _counts:
+        _display(_count)
+      sys.stdout.write ('\n' + 'Render' + '\n' + 'Locations First (ms) Mean (ms)  p99 (ms) Uncached (ms)\n')
+      for _count in _counts:
+        _render(_count, pygame)
+      pygame.quit()
+
+  except KeyboardInterrupt: # Ctrl-C
+    pass
+  except Exception: # Catch all other errors - otherwise the script will just fail silently!
+    import traceback
+    sys.stderr.write (traceback.format_exc())
+    exit(1)
+  finally:
+    if _process:
+      _process.terminate()
+    shutil.rmtree(CACHE, ignore_errors = True) # Doesn't follow the link to the icons
+
+  exit(0)
@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+#
+#-- py-weather-server.py
+#
+#   Local stand in for the OPEN Weather API for testing and benchmarking.
+#
+#   Requires:           python3
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under  the terms of the GNU General Public License as published by  the
+#   Free Software Foundation, either version 3 of the License, or (at  your
+#   option) any later version.
+#
+#   This  program is distributed in the hope that it will  be  useful,  but
+#   WITHOUT   ANY   WARRANTY;   without even  the   implied   warranty   of
+#   MERCHANTABILITY  or  FITNESS  FOR A PARTICULAR  PURPOSE.  See  the  GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   18 Oct 26   0.1   - Initial version - MT
+#                     - Returns made up weather data for any location as
+#                       JSON  or XML (the same location always gets  the
+#                       same weather) - MT
+#                     - Supports the group endpoint used to get the weather
+#                       for several cities using their city IDs - MT
+#                     - Can add a delay to each response and return errors
+#                       at random - MT
+#                     - Locations starting with 'unknown' are not found and
+#                       an application ID of 'invalid' is rejected - MT
+#                     - Accepts more pending connections so clients  don't
+#                       have to wait for the connection to be retried - MT
+#                     - Doesn't report connections closed by clients - MT
+#                     - Also returns the weather for a city ID - MT
+#                     - Added '--chunked' option to send some responses in
+#                       chunks (like nginx does for compressed data) - MT
+#
+VERSION = "0.1"
+
+PORT = 8080
+CHUNK_SIZE = 512 # Size of each chunk when sending a response in chunks
+
+import os, sys, time, json, gzip, random, zlib
+import http.server, urllib.parse
+
+CONDITIONS = [ # Weather id, main, description
+  (200, 'Thunderstorm', 'thunderstorm with light rain'),
+  (211, 'Thunderstorm', 'thunderstorm'),
+  (301, 'Drizzle', 'drizzle'),
+  (500, 'Rain', 'light rain'),
+  (502, 'Rain', 'heavy intensity rain'),
+  (511, 'Rain', 'freezing rain'),
+  (600, 'Snow', 'light snow'),
+  (616, 'Snow', 'rain and snow'),
+  (701, 'Mist', 'mist'),
+  (741, 'Fog', 'fog'),
+  (800, 'Clear', 'clear sky'),
+  (801, 'Clouds', 'few clouds'),
+  (802, 'Clouds', 'scattered clouds'),
+  (804, 'Clouds', 'overcast clouds'),
+]
+
+ICONS = {2: '11', 3: '09', 5: '10', 6: '13', 7: '50', 8: '04'} # Icon for each group of weather codes
+DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+
+def _city(_id): # Name used for a city ID
+  return 'City ' + str(_id)
+
+def _weather(_name, _id = None): # Make up the weather for a location
+  _seed = zlib.crc32(_name.lower().encode())
+  _random = random.Random(_seed) # Same location always gives the same weather
+  _now = int(time.time())
+  (_code, _main, _description) = CONDITIONS[_random.randrange(len(CONDITIONS))]
+  _icon = ('01' if _code == 800 else ICONS[_code // 100]) + _random.choice('dn')
+  _lat = _random.uniform(-60, 70)
+  _lon = _random.uniform(-180, 180)
+  _timezone = int(round(_lon / 15)) * 3600
+  return {
+    'coord': {'lon': round(_lon, 4), 'lat': round(_lat, 4)},
+    'weather': [{'id': _code, 'main': _main, 'description': _description, 'icon': _icon}],
+    'base': 'stations',
+    'main': {'temp': round(_random.uniform(-10, 35), 2), 'feels_like': round(_random.uniform(-15, 35), 2),
+             'pressure': _random.randint(980, 1040), 'humidity': _random.randint(20, 100)},
+    'visibility': 10000,
+    'wind': {'speed': round(_random.uniform(0, 20), 2), 'deg': _random.randint(0, 359)},
+    'clouds': {'all': _random.randint(0, 100)},
+    'dt': _now - _now % 600, # Updated every 10 minutes
+    'sys': {'country': _random.choice(['GB', 'FR', 'DE', 'US', 'JP', 'AU', 'BR']),
+            'sunrise': _now - _now % 86400 + 21600 - _timezone, 'sunset': _now - _now % 86400 + 64800 - _timezone},
+    'timezone': _timezone,
+    'id': _id or (_seed % 9000000 + 1000000),
+    'name': _name.split(',')[0].strip().title(),
+    'cod': 200
+  }
+
+def _convert(_data): # Convert weather data to the XML returned using 'mode=xml'
+  from xml.sax.saxutils import quoteattr
+  def _time(_seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(_seconds))
+  _direction = DIRECTIONS[int((_data['wind']['deg'] + 11.25) // 22.5) % 16]
+  return ('<?xml version="1.0" encoding="UTF-8"?>\n<current>' +
+    '<city id="' + str(_data['id']) + '" name=' + quoteattr(_data['name']) + '>' +
+    '<coord lon="' + str(_data['coord']['lon']) + '" lat="' + str(_data['coord']['lat']) + '"></coord>' +
+    '<country>' + _data['sys']['country'] + '</country>' +
+    '<timezone>' + str(_data['timezone']) + '</timezone>' +
+    '<sun rise="' + _time(_data['sys']['sunrise']) + '" set="' + _time(_data['sys']['sunset']) + '"></sun></city>' +
+    '<temperature value="' + str(_data['main']['temp']) + '" unit="celsius"></temperature>' +
+    '<feels_like value="' + str(_data['main']['feels_like']) + '" unit="celsius"></feels_like>' +
+    '<humidity value="' + str(_data['main']['humidity']) + '" unit="%"></humidity>' +
+    '<pressure value="' + str(_data['main']['pressure']) + '" unit="hPa"></pressure>' +
+    '<wind><speed value="' + str(_data['wind']['speed']) + '" unit="m/s" name="Breeze"></speed><gusts></gusts>' +
+    '<direction value="' + str(_data['wind']['deg']) + '" code="' + _direction + '" name="' + _direction + '"></direction></wind>' +
+    '<clouds value="' + str(_data['clouds']['all']) + '" name=' + quoteattr(_data['weather'][0]['description']) + '></clouds>' +
+    '<visibility value="' + str(_data['visibility']) + '"></visibility>' +
+    '<precipitation mode="no"></precipitation>' +
+    '<weather number="' + str(_data['weather'][0]['id']) + '" value=' + quoteattr(_data['weather'][0]['description']) +
+    ' icon="' + _data['weather'][0]['icon'] + '"></weather>' +
+    '<lastupdate value="' + _time(_data['dt']) + '"></lastupdate></current>')
+
+
+class handler(http.server.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1' # Keep connections open
+  latency = 0
+  errors = 0
+  codes = [500]
+  chunked = 0
+  requests = 0
+  names = {} # Location name for each city ID returned
+
+  def log_message(self, _format, *_args):
+    if _verbose:
+      sys.stderr.write (self.address_string() + ' - ' + (_format % _args) + '\n')
+
+  def reply(self, _status, _body, _type = 'application/json'):
+    _body = _body.encode('utf-8')
+    self.send_response(_status)
+    self.send_header('Content-Type', _type + '; charset=utf-8')
+    if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+      _body = gzip.compress(_body)
+      self.send_header('Content-Encoding', 'gzip')
+    if _status == 429:
+      self.send_header('Retry-After', '60')
+    if self.chunked and random.random() < self.chunked:
+      self.send_header('Transfer-Encoding', 'chunked')
+      self.end_headers()
+      for _start in range(0, len(_body), CHUNK_SIZE):
+        _chunk = _body[_start:_start + CHUNK_SIZE]
+        self.wfile.write(('%x\r\n' % len(_chunk)).encode('latin-1') + _chunk + b'\r\n')
+      self.wfile.write(b'0\r\n\r\n') # Last chunk (with no trailers)
+    else:
+      self.send_header('Content-Length', str(len(_body)))
+      self.end_headers()
+      self.wfile.write(_body)
+
+  def error(self, _status, _message, _xml):
+    if _xml:
+      self.reply(_status, '<?xml version="1.0" encoding="UTF-8"?>\n<ClientError><cod>' + str(_status) +
+                 '</cod><message>' + _message + '</message></ClientError>', 'application/xml')
+    else:
+      self.reply(_status, json.dumps({'cod': str(_status), 'message': _message}))
+
+  def do_GET(self):
+    handler.requests += 1
+    _parts = urllib.parse.urlsplit(self.path)
+    _query = dict(urllib.parse.parse_qsl(_parts.query))
+    _xml = _query.get('mode') == 'xml'
+    if self.latency:
+      time.sleep(self.latency)
+    if self.errors and random.random() < self.errors:
+      _status = random.choice(self.codes)
+      return self.error(_status, http.server.BaseHTTPRequestHandler.responses.get(_status, ('Error',))[0].lower(), _xml)
+    if _query.get('appid', '') in ['', 'invalid']:
+      return self.error(401, 'Invalid API key.', _xml)
+    if _parts.path.endswith('/weather'):
+      if _query.get('id', '').isdigit():
+        _data = _weather(handler.names.get(int(_query['id']), _city(_query['id'])), int(_query['id']))
+      else:
+        _location = _query.get('q', '')
+        if _location == '' or _location.lower().startswith('unknown'):
+          return self.error(404, 'city not found', _xml)
+        _data = _weather(_location)
+        handler.names[_data['id']] = _location
+      if _xml:
+        return self.reply(200, _convert(_data), 'application/xml')
+      return self.reply(200, json.dumps(_data))
+    if _parts.path.endswith('/group'):
+      _list = [_weather(handler.names.get(int(_id), _city(_id)), int(_id)) for _id in _query.get('id', '').split(',') if _id.isdigit()]
+      return self.reply(200, json.dumps({'cnt': len(_list), 'list': _list}))
+    return self.error(404, 'Internal error', _xml)
+
+
+class server(http.server.ThreadingHTTPServer):
+  request_queue_size = 128 # Connections refused when the queue is full are retried after a second
+  daemon_threads = True
+
+  def handle_error(self, _request, _address): # Clients that are stopped may leave idle connections open
+    if not isinstance(sys.exc_info()[1], ConnectionError):
+      http.server.ThreadingHTTPServer.handle_error(self, _request, _address)
+
+
+def serve(_port = PORT, _latency = 0, _errors = 0, _codes = [500], _chunked = 0): # Start the server (and never return)
+  handler.latency = _latency
+  handler.errors = _errors
+  handler.codes = _codes
+  handler.chunked = _chunked
+  _server = server(('127.0.0.1', _port), handler)
+  sys.stdout.write ('http://127.0.0.1:' + str(_server.server_address[1]) + '/data/2.5/\n')
+  sys.stdout.flush()
+  _server.serve_forever()
+
+if __name__ == '__main__':
+
+  def _about():
+    sys.stdout.write(
+      "Usage: " + sys.argv[0] + " [OPTION]...\n" +
+      "Serve made up weather data for testing.\n" + "\n" +
+      "      --port <n>           listen on port n (default " + str(PORT) + ", 0 for any) \n" +
+      "      --latency <ms>       wait before sending each response \n" +
+      "      --errors <rate>      fraction of requests that fail (0 to 1) \n" +
+      "      --codes <list>       status codes used for errors (default 500) \n" +
+      "      --chunked <rate>     fraction of responses sent in chunks (0 to 1) \n" +
+      "      --verbose            log each request \n" +
+      "  -?, --help               display this help and exit\n" +
+      "      --version            output version information and exit\n" +
+      "\nExample:\n" +
+      "  " + os.path.basename(sys.argv[0]) + " --latency 50 --errors 0.1 --codes 429,503\n")
+    raise SystemExit
+
+  def _version():
+    sys.stdout.write(os.path.basename(sys.argv[0]) + " " + str(VERSION) +"\n"
+      "License GPLv3+: GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.\n"
+      "This is free software: you are free to change and redistribute it.\n"
+      "There is NO WARRANTY, to the extent permitted by law.\n")
+    raise SystemExit
+
+  def _error(_error):
+    sys.stderr.write(os.path.basename(sys.argv[0]) + ": " + _error + "\n")
+    raise SystemExit
+
+  def _value(_count, _convert): # Get the value for an option
+    try:
+      return _convert(sys.argv[_count + 1])
+    except (IndexError, ValueError):
+      _error ("invalid value for option -- '" + sys.argv[_count][2:] + "'")
+
+  try:
+    _verbose = False
+    _port = PORT
+    _latency = 0
+    _errors = 0
+    _codes = [500]
+    _chunked = 0
+
+    _count = 1
+    while _count < len(sys.argv):
+      _arg = sys.argv [_count]
+      if _arg in ["--help", "-?"]:
+        _about()
+      elif _arg in ["--version"]:
+        _version()
+      elif _arg in ["--verbose"]:
+        _verbose = True
+      elif _arg in ["--port"]:
+        _port = _value(_count, int)
+        _count += 1
+      elif _arg in ["--latency"]:
+        _latency = _value(_count, float) / 1000
+        _count += 1
+      elif _arg in ["--errors"]:
+        _errors = _value(_count, float)
+        _count += 1
+      elif _arg in ["--codes"]:
+        _codes = _value(_count, lambda _list: [int(_code) for _code in _list.split(',')])
+        _count += 1
+      elif _arg in ["--chunked"]:
+        _chunked = _value(_count, float)
+        _count += 1
+      elif _arg[:2] == "--":
+        _error ("unrecognized option -- '" + (_arg[1:] + "'"))
+      else:
+        _error ("invalid option -- '" + (_arg[1:] + "'"))
+      _count += 1
+
+    serve(_port, _latency, _errors, _codes, _chunked)
+
+  except KeyboardInterrupt: # Ctrl-C
+    pass
+  except Exception: # Catch all other errors - otherwise the script will just fail silently!
+    import traceback
+    sys.stderr.write (traceback.format_exc())
+    exit(1)
+
+  exit(0)
@@ -35,98 +35,359 @@
 #   10 Feb 21         - Removed  custom  event handlers.  Instead uses  the
 #                       standard  exception handling to trap  any  keyboard
 #                       interupts (and errors) - MT
+#   18 Oct 26   0.2   - Gets  the weather for all the locations at the same
+#                       time  using a pool of threads (the number of  which
+#                       can be set using the '--jobs' option) - MT
+#                     - Fixed location name in error messages - MT
+#                     - Responses are kept in a cache shared by all running
+#                       copies (and py-pygame-weather.py) until the data is
+#                       likely to have changed - MT
+#                     - Added '--nocache' option - MT
+#                     - Reuses connections to the server and asks for  the
+#                       data to be compressed - MT
+#                     - Added '--base-url' option to use a different server
+#                       (such as py-weather-server.py) - MT
+#                     - Only keeps the values used from each response  (in
+#                       a  snapshot object) instead of the whole document,
+#                       converting them when the weather is updated - MT
+#                     - Writes  the weather for each location as soon as it
+#                       is available (in the same order as the locations),
+#                       as text, JSON lines or CSV ('--format') - MT
+#                     - Added  '--locations-file' option to read  locations
+#                       from a file (or stdin) - MT
+#                     - Each location is only fetched once even if it  is
+#                       repeated  (ignoring case and spaces)  but is  still
+#                       displayed every time it appears - MT
+#                     - Added  '--daemon' option to keep the weather up  to
+#                       date and answer queries from a (Unix domain) socket
+#                       and '--client' option to query it - MT
+#                     - Network errors and timeouts no longer stop it - MT
+#                     - Modules are only imported when they are needed (so
+#                       the client doesn't load the modules  used to fetch
+#                       the weather for example) - MT
+#                     - The '--debug' option also reports how long it took
+#                       to import each module and to write the first  line
+#                       of output - MT
+#                     - Uses  openweather.py to fetch the weather  (shared
+#                       with  py-pygame-weather.py), which sends  all  the
+#                       requests at the same time using asyncio - MT
+#                     - An unexpected response no longer stops it - MT
+#                     - Added  '--rate' option to set the maximum  number
+#                       of requests each minute - MT
+#                     - Added '--metrics' option to serve how long each
+#                       stage of a request takes (and other counters) in
+#                       Prometheus format, which are also summarized on
+#                       exit by '--verbose' - MT
+#                     - Added '--profile' option to profile a run - MT
+#                     - Added '--build-index' option to build an index of
+#                       the  cities in the OpenWeather bulk city list, and
+#                       '--find' option to search it by name - MT
+#                     - Locations  are looked up in the index  (if it has
+#                       been built) so the weather can be requested using
+#                       the city ID ('--noindex' to disable) - MT
+#                     - Added  '--near' option to get the weather  at  the
+#                       nearest city to a latitude and longitude - MT
+#                     - Only extracts the elements used from the response
+#                       (which no longer needs xmltodict) - MT
+#                     - The daemon remembers locations it couldn't find  (so
+#                       it doesn't ask again until it is time to retry) and
+#                       stops updating locations added by queries when they
+#                       aren't used (or there are too many) - MT
+#                     - Uses startup.py (shared with py-pygame-weather.py)
+#                       to time the imports - MT
 #
-VERSION = "0.1"
+VERSION = "0.2"
+
+JOBS = 8 # Maximum number of locations to fetch at the same time
+INTERVAL = 900 # Update interval (daemon)
+RETRY = 300 # How long to remember locations that couldn't be fetched before asking again (daemon)
+EXPIRE = 86400 # Locations added by queries are dropped if they aren't asked for again in this time (daemon)
+LOCATIONS = 1000 # Maximum number of locations added by queries to keep up to date (daemon)
+FORMATS = ['text', 'json', 'csv']
+FIELDS = ('city', 'coord', 'country', 'sun', 'temperature', 'humidity', 'pressure', 'clouds', 'speed', 'direction',
+          'weather', 'lastupdate') # Elements used from each response
+
+import sys, time, threading
+
+_started = time.perf_counter() # Used to measure how long it takes to start
+
+
+import startup # Times each import if '--debug' is specified (so it has to be imported first)
+
+import os, itertools, collections
+
+CACHE_FOLDER = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'py-weather') # Same as openweather.py
+SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or CACHE_FOLDER, 'py-weather.sock') # Used to query the daemon
+
+
+def _attribute(_element, _name, _convert = str): # Get the value of an attribute if the element is present
+  if _element is None or _element.get(_name) is None:
+    return None
+  return _convert(_element[_name])
+
+def _utc(_value): # Convert UTC time (from XML) to seconds since the epoch
+  import calendar
+  return calendar.timegm(time.strptime(_value, '%Y-%m-%dT%H:%M:%S'))
+
+
+class snapshot(object): # Weather conditions at a location (extracted from the response)
+
+  __slots__ = ('city', 'name', 'country', 'latitude', 'longitude', 'code', 'icon', 'description', 'summary',
+               'temperature', 'humidity', 'pressure', 'clouds', 'cover', 'speed', 'wind', 'direction', 'bearing',
+               'sunrise', 'sunset', 'updated')
+
+  def __init__(self, _weather): # Elements in the response
+    self.city = int(_weather['city']['id'])
+    self.name = _weather['city']['name']
+    self.country = _attribute(_weather.get('country'), '#text') or ''
+    self.latitude = float(_weather['coord']['lat'])
+    self.longitude = float(_weather['coord']['lon'])
+    self.code = int(_weather['weather']['number'])
+    self.icon = _weather['weather']['icon']
+    self.description = _weather['weather']['value'].title()
+    self.summary = self.description.replace('Intensity ', '') # 'Heavy Rain' looks better than 'Heavy Intensity Rain'
+    self.temperature = float(_weather['temperature']['value'])
+    self.humidity = float(_weather['humidity']['value'])
+    self.pressure = float(_weather['pressure']['value'])
+    self.clouds = _attribute(_weather.get('clouds'), 'value', float) # Cloud and wind data may not be available
+    self.cover = (_attribute(_weather.get('clouds'), 'name') or '').title()
+    self.speed = _attribute(_weather.get('speed'), 'value', float)
+    self.wind = (_attribute(_weather.get('speed'), 'name') or '').title()
+    self.direction = _attribute(_weather.get('direction'), 'value', float)
+    self.bearing = _attribute(_weather.get('direction'), 'code') or ''
+    self.sunrise = _utc(_weather['sun']['rise'])
+    self.sunset = _utc(_weather['sun']['set'])
+    self.updated = _utc(_weather['lastupdate']['value'])
+
+  def dict(self):
+    return dict([(_name, getattr(self, _name)) for _name in self.__slots__])
+
+
+class formatter(object): # Converts the weather at each location to the selected format
+
+  TEXT = ('Location : \t\t%(name)s (%(country)s)\n' +
+          'Temprature : \t\t%(temperature).0f C\n' +
+          'Description: \t\t%(summary)s\n')
+
+  def __init__(self, _format = 'text'):
+    import operator
+    self.format = _format
+    self.fields = snapshot.__slots__
+    self.values = operator.attrgetter(*self.fields) # Get all the values at once
+    if _format == 'json':
+      import json
+      self.encoder = json.JSONEncoder(ensure_ascii = False)
+    elif _format == 'csv':
+      import csv, io
+      self.buffer = io.StringIO()
+      self.writer = csv.writer(self.buffer, lineterminator = '\n')
+
+  def row(self, _values): # Format values as a line of CSV
+    self.buffer.seek(0)
+    self.buffer.truncate()
+    self.writer.writerow(_values)
+    return self.buffer.getvalue()
+
+  def header(self):
+    if self.format == 'csv':
+      return self.row(self.fields)
+    return ''
+
+  def line(self, _snapshot):
+    if self.format == 'json':
+      return self.encoder.encode(dict(zip(self.fields, self.values(_snapshot)))) + '\n'
+    if self.format == 'csv':
+      return self.row(self.values(_snapshot))
+    return self.TEXT % dict(zip(self.fields, self.values(_snapshot)))
+
+
+def _read(_filename): # Read locations from a file or stdin (as they are needed)
+  import openweather
+  yield from openweather.read(_filename)
 
-import os, sys, signal
 
 class weather(object):
 
-  def __init__(self, _location, _appid):
+  def __init__(self, _location, _appid, _result = None):
     self.location = _location
     self.appid = _appid
     self.units = 'metric'
-    self.weather = ""
+    self.weather = None
     self.status = 0 
     self.error = None
-    self.update() # Get the current weather for the specified location
+    self.retry = 0 # Time the server asked us to wait
+    self.update(_result) # Get the current weather for the specified location (unless it has already been fetched)
 
-  def update(self): # Update Weather data.
-
-    import xmltodict, urllib, json
-    import time
-    
-    _URI = ('https://api.openweathermap.org/data/2.5/weather?units=' + 
-           urllib.parse.quote(self.units) + '&mode=xml&q=' + urllib.parse.quote(self.location) + '&appid=' + urllib.parse.quote(self.appid ))
-
-    self.status = 0 # Clear any current errors
-    self.error = ''
-    try: 
-      _socket = urllib.request.urlopen(_URI)
-      _data=_socket.read()
-      _socket.close()
-      self.weather = xmltodict.parse(_data) # Convert XML response to a python dictionary 
-      if _debug: 
-        sys.stderr.write (self.weather['current']['city']['@name'] + "\n")
-        sys.stderr.write (json.dumps(self.weather, indent=4) + "\n") # Dump dictionary as JSON.
-      elif _verbose:
-        self.list()
-    except urllib.error.HTTPError as _Error:
-      self.status = _Error.code
-      if _Error.code == 404:
-        sys.stderr.write ('Error : ' + str(_Error.code) + ' - ' + 'Location (' + _location + ') not found.')
-        self.error = 'Location (' + _location + ') not found.'
-      elif _Error.code == 401: 
-        sys.stderr.write ('Error : ' + str(_Error.code) + ' - ' + 'Check your application ID is valid.')
-        self.error = 'Check your application ID is valid.'
+  def update(self, _result = None): # Update Weather data.
+    if _result is None:
+      import openweather
+      _result = openweather.run(openweather.fetch(self.location, self.appid, 'xml', self.units, _fields = FIELDS))
+    self.status = _result.status
+    self.error = _result.error
+    self.retry = _result.retry
+    if not self.status:
+      try:
+        _snapshot = snapshot(_result.data)
+      except (KeyError, IndexError, TypeError, ValueError) as _Error: # Not what we expected
+        self.status = -1
+        self.error = 'Invalid response (' + type(_Error).__name__ + ': ' + str(_Error) + ')'
+    if self.status:
+      if self.status > 0:
+        sys.stderr.write ('Error : ' + str(self.status) + ' - ' + self.error + '\n')
       else:
-        sys.stderr.write ('Error : ' + str(_Error.code) + ' - ' + _Error.reason)
-        self.error = str(_Error.reason)
-      sys.stderr.write ('\n')
-    except Exception:
-      import traceback
-      self.status = -1
-      sys.stderr.write (traceback.format_exc())
-      exit(self.status)
+        sys.stderr.write ('Error : ' + self.error + '\n')
+      return # Keep the previous weather data
+    self.weather = _snapshot
+    if _debug: 
+      import json
+      sys.stderr.write (self.weather.name + "\n")
+      sys.stderr.write (json.dumps(_result.data, indent=4) + "\n") # Dump dictionary as JSON.
+    elif _verbose:
+      self.list()
 
   def list(self): # Print Weather data.
-    import time, calendar
-
-    _output = 'Location : \t\t'
-    _output += self.weather['current']['city']['@name'] + '\n'
-    _output += 'Country : \t\t'
-    _output += self.weather['current']['city']['country'] + '\n'
-    _output += 'Lat/Long : \t\t'
-    _output += '%+06.2f' % float(self.weather['current']['city']['coord']['@lat']) + ',' + '%+07.2f' % float(self.weather['current']['city']['coord']['@lon']) + '\n'
-    _output += 'Sunrise : \t\t' 
-    _output += time.strftime('%a %d %b %Y %I:%M %p %Z', time.localtime(calendar.timegm(time.strptime(self.weather['current']['city']['sun']['@rise'],'%Y-%m-%dT%H:%M:%S')))) + '\n'
-    _output += 'Sunset : \t\t'
-    _output += time.strftime('%a %d %b %Y %I:%M %p %Z', time.localtime(calendar.timegm(time.strptime(self.weather['current']['city']['sun']['@set'],'%Y-%m-%dT%H:%M:%S')))) + '\n\n'
-    _output += 'Description: \t\t'
-    _output += self.weather['current']['weather']['@value'].title() + '\n'
-    _output += 'Temprature : \t\t'
-    _output += '%0.f' % round(float(self.weather['current']['temperature']['@value'])) + ' C\n'
-    _output += 'Humidity : \t\t'
-    _output += '%d' % float(self.weather['current']['humidity']['@value']) + ' %\n'
-    _output += 'Pressure : \t\t'
-    _output += '%d' % (float(self.weather['current']['pressure']['@value'])) + ' mb/hPa\n'
-    if not self.weather['current']['clouds'] is None: # Check cloud data is available
-      _output += 'Cloud Cover : \t\t' + '%d' % (float(self.weather['current']['clouds']['@value'])) + ' % '
-      _output += '(' + self.weather['current']['clouds']['@name'].title() + ')\n'
-    if not self.weather['current']['wind']['speed'] is None: # Check wind speed data is available
-      _output += 'Wind Speed : \t\t' + '%d' % (float(self.weather['current']['wind']['speed']['@value']) * 3.6) + ' km/h ' 
-      _output += '(' + self.weather['current']['wind']['speed']['@name'].title() + ')\n'
-    if not self.weather['current']['wind']['direction'] is None: # Check wind direction data is available
-      _output += 'Wind Direction : \t' +  '%d' % float(self.weather['current']['wind']['direction']['@value']) + u'\xb0 ' 
-      _output += '(' + self.weather['current']['wind']['direction']['@code'] + ')\n\n'
-    _output += 'Updated : \t\t' + time.strftime('%a %d %b %Y %I:%M %p %Z', time.localtime(calendar.timegm(time.strptime(self.weather['current']['lastupdate']['@value' ],'%Y-%m-%dT%H:%M:%S')))) + '\n\n'
-    sys.stderr.write (_output)
+    def _local(_time):
+      return time.strftime('%a %d %b %Y %I:%M %p %Z', time.localtime(_time))
+
+    _weather = self.weather
+    _output = [
+      'Location : \t\t', _weather.name, '\n',
+      'Country : \t\t', _weather.country, '\n',
+      'Lat/Long : \t\t', '%+06.2f' % _weather.latitude, ',', '%+07.2f' % _weather.longitude, '\n',
+      'Sunrise : \t\t', _local(_weather.sunrise), '\n',
+      'Sunset : \t\t', _local(_weather.sunset), '\n\n',
+      'Description: \t\t', _weather.description, '\n',
+      'Temprature : \t\t', '%0.f' % round(_weather.temperature), ' C\n',
+      'Humidity : \t\t', '%d' % _weather.humidity, ' %\n',
+      'Pressure : \t\t', '%d' % _weather.pressure, ' mb/hPa\n']
+    if not _weather.clouds is None: # Check cloud data is available
+      _output += ['Cloud Cover : \t\t', '%d' % _weather.clouds, ' % ', '(', _weather.cover, ')\n']
+    if not _weather.speed is None: # Check wind speed data is available
+      _output += ['Wind Speed : \t\t', '%d' % (_weather.speed * 3.6), ' km/h ', '(', _weather.wind, ')\n']
+    if not _weather.direction is None: # Check wind direction data is available
+      _output += ['Wind Direction : \t', '%d' % _weather.direction, u'\xb0 ', '(', _weather.bearing, ')\n\n']
+    _output += ['Updated : \t\t', _local(_weather.updated), '\n\n']
+    sys.stderr.write (''.join(_output))
 
   def dump(self): # Print Weather data.
     import json
-    sys.stderr.write (json.dumps(self.weather, indent=4) + "\n") # Dump dictionary as JSON.
+    sys.stderr.write (json.dumps(self.weather.dict(), indent=4) + "\n") # Dump snapshot as JSON.
       
   
+class daemon(object): # Keeps the weather up to date and answers queries from a socket
+
+  def __init__(self, _appid, _jobs = JOBS):
+    self.appid = _appid
+    self.jobs = _jobs
+    self.weather = {} # Weather for each location
+    self.used = collections.OrderedDict() # When each location added by a query was last asked for (least recent first)
+    self.failed = {} # Locations that couldn't be fetched and when to try again
+    self.lock = threading.Lock()
+
+  def fetch(self, _locations): # Get the weather for each location at the same time
+    import openweather
+    return openweather.run(openweather.fetch_many(_locations, self.appid, self.jobs, _mode = 'xml', _fields = FIELDS))
+
+  def add(self, _locations, _keep = False): # Get the weather for any new locations (always keeping them if keep is set)
+    import openweather
+    _locations = list(_locations)
+    _keys = [openweather.normalize(_location) for _location in _locations]
+    _names = collections.OrderedDict() # Location as it was given for each key (used in error messages)
+    for (_key, _location) in zip(_keys, _locations):
+      _names.setdefault(_key, _location)
+    _now = time.time()
+    with self.lock:
+      for _key in _names:
+        if not _keep and (_key in self.used or not _key in self.weather): # Locations from the command line are never dropped
+          self.used[_key] = _now
+          self.used.move_to_end(_key)
+      self.prune(_now)
+      _known = dict([(_key, self.weather.get(_key) or self.failed[_key][0]) for _key in _names if _key in self.weather or _key in self.failed])
+      _new = [_key for _key in _names if not _key in _known]
+    _items = dict(zip(_new, [weather(_result.location, self.appid, _result) for _result in self.fetch([_names[_key] for _key in _new])]))
+    with self.lock:
+      for _key in _new:
+        if not _items[_key].status: # Only keep the location if successful
+          self.weather[_key] = _items[_key]
+        else: # Don't ask for it again until it is time to retry
+          self.failed[_key] = (_items[_key], time.time() + max(RETRY, _items[_key].retry))
+      return [self.weather.get(_key) or _items.get(_key) or _known[_key] for _key in _keys]
+
+  def prune(self, _now): # Forget failures once it is time to retry and drop locations that are no longer used (lock must be held)
+    for _key in [_key for (_key, (_item, _until)) in self.failed.items() if _until <= _now]:
+      del self.failed[_key]
+    while self.used and (len(self.used) > LOCATIONS or next(iter(self.used.values())) < _now - EXPIRE): # Least recently used first
+      (_key, _time) = self.used.popitem(last = False)
+      self.weather.pop(_key, None)
+
+  def refresh(self): # Update the weather every INTERVAL seconds
+    while True:
+      _now = time.time()
+      time.sleep((_now - _now % INTERVAL) + INTERVAL - _now)
+      with self.lock:
+        self.prune(time.time())
+        _items = list(self.weather.values())
+      for (_item, _result) in zip(_items, self.fetch([_item.location for _item in _items])):
+        _item.update(_result) # Keeps the previous weather if an update fails
+
+  def query(self, _request): # Format first line, then locations (one per line)
+    import openweather
+    with openweather.metrics.timer('query'):
+      return self.answer(_request)
+
+  def answer(self, _request):
+    _lines = _request.split('\n')
+    _format = _lines[0].strip() if _lines[0].strip() in FORMATS else 'text'
+    _locations = [_line.strip() for _line in _lines[1:] if _line.strip()]
+    if _locations:
+      _items = self.add(_locations)
+    else: # Return all the locations
+      with self.lock:
+        _items = list(self.weather.values())
+    _formatter = formatter(_format)
+    _output = [_formatter.header()]
+    for _item in _items:
+      if _item.weather is None: # Errors start with '!'
+        _output.append('!' + _item.error + '\n')
+      else:
+        _output.append(_formatter.line(_item.weather))
+    return ''.join(_output)
+
+  def serve(self, _path):
+    import socketserver
+    _daemon = self
+    class handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        _request = self.rfile.read().decode('utf-8') # Client closes its side when it has finished sending
+        self.wfile.write(_daemon.query(_request).encode('utf-8'))
+    os.makedirs(os.path.dirname(_path), exist_ok = True) # Cache folder may not exist yet (if not using the cache)
+    if os.path.exists(_path):
+      os.unlink(_path) # Remove socket left behind by a previous instance
+    _server = socketserver.ThreadingUnixStreamServer(_path, handler)
+    _server.daemon_threads = True
+    threading.Thread(target = self.refresh, daemon = True).start()
+    try:
+      _server.serve_forever()
+    finally:
+      _server.server_close()
+      os.unlink(_path)
+
+
+def _client(_path, _format, _locations): # Get the weather from the daemon
+  import socket
+  _socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  _socket.connect(_path)
+  _socket.sendall((_format + '\n' + ''.join([_location + '\n' for _location in _locations])).encode('utf-8'))
+  _socket.shutdown(socket.SHUT_WR) # Finished sending
+  _response = _socket.makefile('r', encoding = 'utf-8')
+  for _line in _response:
+    if _line[:1] == '!':
+      sys.stderr.write ('Error : ' + _line[1:])
+    else:
+      sys.stdout.write (_line)
+  _socket.close()
+
+
 if __name__ == '__main__': 
 
   def _about():
@@ -134,9 +395,29 @@ if __name__ == '__main__':
       "Usage: " + sys.argv[0] + " [LOCATION]...\n" +
       "Display weather conditions at LOCATION(s).\n" + "\n" +
       "      --appid <key>        specify the API key \n" +
+      "      --base-url <url>     use a different server \n" +
+      "      --build-index <file> build the city index from the bulk city list \n" +
+      "                           (city.list.json.gz) and exit \n" +
+      "      --client             get the weather from the daemon \n" +
+      "      --daemon             keep the weather for LOCATION(s) up to date and\n" +
+      "                           answer queries from a socket \n" +
+      "      --find <name>        list the cities in the index starting with name \n" +
+      "                           and exit \n" +
+      "      --jobs <n>           fetch up to n locations at the same time \n" +
+      "      --locations-file <f> read locations from file f ('-' for stdin) \n" +
+      "      --metrics <port>     serve timings and counters (Prometheus format) \n" +
+      "                           on port \n" +
+      "      --near <lat,lon>     display weather at the nearest city in the index \n" +
+      "      --nocache            do not use cached responses \n" +
+      "      --noindex            do not look up locations in the city index \n" +
+      "      --rate <n>           send no more than n requests a minute \n" +
+      "      --profile <file>     profile the run and write the results to file \n" +
+      "                           (cProfile if it ends in .prof or sampled stacks) \n" +
+      "      --socket <path>      socket used by the daemon \n" +
       "  -?, --help               display this help and exit\n" +
       "      --version            output version information and exit\n" +
       "      --debug              dump raw data as JSON\n" +
+      "      --format <format>    output format (" + ', '.join(FORMATS) + ")\n" +
       "\nExample:\n" +
       "  " + os.path.basename(sys.argv[0]) + " London display weather in London.\n")
     raise SystemExit
@@ -152,10 +433,35 @@ if __name__ == '__main__':
     sys.stderr.write(os.path.basename(sys.argv[0]) + ": " + _error + "\n")
     raise SystemExit
 
+  def _nearest(_position): # Nearest city in the index to 'latitude,longitude'
+    import openweather
+    try:
+      (_latitude, _longitude) = [float(_value) for _value in _position.split(',')]
+    except ValueError:
+      _error ("invalid position -- '" + _position + "'")
+    if not -90 <= _latitude <= 90 or not -180 <= _longitude <= 180:
+      _error ("invalid position -- '" + _position + "'")
+    _places = openweather.cities.near(_latitude, _longitude)
+    if not _places:
+      _error ("city index not found (use --build-index)")
+    return '#' + str(_places[0][1].id) # City ID
+
   try:      
     _debug = False
     _verbose = False
     _humidity = False
+    _jobs = JOBS
+    _format = 'text'
+    _mode = None
+    _socket = SOCKET
+    _cache = True
+    _api = None
+    _rate = None
+    _port = None
+    _profile = None
+    _index = True
+    _city_list = None
+    _search = None
 
     _locations = []
     _count = 1
@@ -173,6 +479,80 @@ if __name__ == '__main__':
           _debug = True
         elif _arg in ["--humidity"]:
           _humidity = True
+        elif _arg in ["--nocache"]:
+          _cache = False
+        elif _arg in ["--base-url"]:
+          if _count + 1 < len(sys.argv):
+            _api = sys.argv[_count + 1].rstrip('/') + '/'
+            _count += 1
+          else:
+            _error ("base URL not specified")
+        elif _arg in ["--rate"]:
+          if _count + 1 < len(sys.argv) and sys.argv[_count + 1].isdigit() and int(sys.argv[_count + 1]) > 0:
+            _rate = int(sys.argv[_count + 1])
+            _count += 1
+          else:
+            _error ("invalid rate")
+        elif _arg in ["--metrics"]:
+          if _count + 1 < len(sys.argv) and sys.argv[_count + 1].isdigit():
+            _port = int(sys.argv[_count + 1])
+            _count += 1
+          else:
+            _error ("invalid port")
+        elif _arg in ["--profile"]:
+          if _count + 1 < len(sys.argv):
+            _profile = sys.argv[_count + 1]
+            _count += 1
+          else:
+            _error ("profile not specified")
+        elif _arg in ["--build-index"]:
+          if _count + 1 < len(sys.argv) and os.path.isfile(sys.argv[_count + 1]):
+            _city_list = sys.argv[_count + 1]
+            _count += 1
+          else:
+            _error ("city list not found")
+        elif _arg in ["--find"]:
+          if _count + 1 < len(sys.argv):
+            _search = sys.argv[_count + 1]
+            _count += 1
+          else:
+            _error ("name not specified")
+        elif _arg in ["--near"]:
+          if _count + 1 < len(sys.argv):
+            _locations.append([_nearest(sys.argv[_count + 1])])
+            _count += 1
+          else:
+            _error ("position not specified")
+        elif _arg in ["--noindex"]:
+          _index = False
+        elif _arg in ["--format"]:
+          if _count + 1 < len(sys.argv) and sys.argv[_count + 1] in FORMATS:
+            _format = sys.argv[_count + 1]
+            _count += 1
+          else:
+            _error ("invalid format")
+        elif _arg in ["--locations-file"]:
+          if _count + 1 < len(sys.argv) and (sys.argv[_count + 1] == "-" or os.path.isfile(sys.argv[_count + 1])):
+            _locations.append(_read(sys.argv[_count + 1]))
+            _count += 1
+          else:
+            _error ("locations file not found")
+        elif _arg in ["--daemon"]:
+          _mode = 'daemon'
+        elif _arg in ["--client"]:
+          _mode = 'client'
+        elif _arg in ["--socket"]:
+          if _count + 1 < len(sys.argv):
+            _socket = sys.argv[_count + 1]
+            _count += 1
+          else:
+            _error ("socket not specified")
+        elif _arg in ["--jobs"]:
+          if _count + 1 < len(sys.argv) and sys.argv[_count + 1].isdigit() and int(sys.argv[_count + 1]) > 0:
+            _jobs = int(sys.argv[_count + 1])
+            _count += 1
+          else:
+            _error ("invalid number of jobs")
         elif _arg in "--appid":
           if _count < len(sys.argv):
             if sys.argv[_count + 1][:1] != "-":
@@ -184,32 +564,82 @@ if __name__ == '__main__':
           else:
             _error ("invalid option -- '" + (_arg[1:] + "'"))
       else:
-        _locations.append(_arg)
+        _locations.append(_read(_arg) if _arg == "-" else [_arg])
       _count += 1
 
+    if _city_list:
+      import openweather
+      _cities = openweather.build_index(_city_list)
+      if _verbose:
+        sys.stderr.write ('Indexed : \t\t' + str(_cities) + ' cities (' + openweather.CITY_INDEX + ')\n')
+      raise SystemExit
+
+    if _search is not None:
+      import openweather
+      for _place in openweather.cities.find(_search):
+        sys.stdout.write ('%9d' % _place.id + '  ' + _place.name.ljust(32) + '%+08.4f,%+09.4f' % (_place.latitude, _place.longitude) + '\n')
+      raise SystemExit
+
+    if _mode == 'client':
+      try:
+        _client(_socket, _format, itertools.chain.from_iterable(_locations))
+      except (ConnectionError, FileNotFoundError):
+        _error ("daemon not running (" + _socket + ")")
+      raise SystemExit
+
     if _appid == "":
       _error ("APPID not specified")
 
-    _weather = []
-
-    for _location in _locations[:1]:
-      _item = weather(_location, _appid) # Get the weather for the location (left, top, width, height)
-      if not _item.status: # Only add it to the list of weather results if successful
-        _weather.append(_item) 
-
-    for _location in _locations[1:]:
-      _item = weather( _location, _appid) # Get the weather for the location (left, top, width, height)
-      if not _item.status: # Only add it to the list of weather results if successful
-        _weather.append(_item) 
-     
-    for _item in _weather:
-      _output = 'Location : \t\t'
-      _output += _item.weather['current']['city']['@name'] + ' (' + _item.weather['current']['city']['country'] +')\n'
-      _output += 'Temprature : \t\t'
-      _output += '%0.f' % round(float(_item.weather['current']['temperature']['@value'])) + ' C\n'
-      _output += 'Description: \t\t'
-      _output += _item.weather['current']['weather']['@value'].title().replace('Intensity ','') + '\n'      
-      sys.stdout.write(_output)
+    import openweather
+    openweather.cache.enabled = _cache
+    openweather.cities.enabled = _index
+    if _api:
+      openweather.API = _api
+    if _rate:
+      openweather.limit.set(_rate)
+    if _profile:
+      import atexit
+      _profiler = openweather.profiler(_profile)
+      _profiler.start()
+      atexit.register(_profiler.stop) # Write the profile however it exits
+    if _port is not None:
+      openweather.metrics.serve(_port)
+
+    if _mode == 'daemon':
+      import signal
+      signal.signal(signal.SIGTERM, lambda _signal, _frame: sys.exit(0)) # Tidy up when killed
+      _daemon = daemon(_appid, _jobs)
+      _daemon.add(itertools.chain.from_iterable(_locations), _keep = True)
+      _daemon.serve(_socket)
+
+    _formatter = formatter(_format)
+    sys.stdout.write(_formatter.header())
+
+    async def _main(): # Write the weather for each location as soon as it is available
+      _first = None
+      async for _result in openweather.fetch_each(itertools.chain.from_iterable(_locations), _appid, _jobs, _mode = 'xml', _fields = FIELDS):
+        with openweather.metrics.timer('update'):
+          _item = weather(_result.location, _appid, _result)
+        if not _item.status: # Only display the weather if successful
+          with openweather.metrics.timer('format'):
+            _line = _formatter.line(_item.weather)
+          sys.stdout.write(_line)
+          sys.stdout.flush()
+          if _first is None:
+            _first = time.perf_counter() - _started
+      return _first
+
+    _first = openweather.run(_main())
+
+    if _verbose:
+      sys.stderr.write (openweather.cache.stats())
+      sys.stderr.write (openweather.pool.stats())
+      sys.stderr.write (openweather.limit.stats())
+      sys.stderr.write (openweather.metrics.summary())
+    if _debug:
+      sys.stderr.write (startup.modules.report())
+      if _first is not None:
+        sys.stderr.write ('First line : \t\t' + '%.1f' % (_first * 1000) + ' ms\n')
 
   except KeyboardInterrupt: # Ctrl-C
     pass
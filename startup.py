@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+#
+#-- startup.py
+#
+#   Measures how long it takes to import each module (used by py-weather.py
+#   and py-pygame-weather.py, which import it before anything else).
+#
+#   Requires:           python3
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under  the terms of the GNU General Public License as published by  the
+#   Free Software Foundation, either version 3 of the License, or (at  your
+#   option) any later version.
+#
+#   This  program is distributed in the hope that it will  be  useful,  but
+#   WITHOUT   ANY   WARRANTY;   without even  the   implied   warranty   of
+#   MERCHANTABILITY  or  FITNESS  FOR A PARTICULAR  PURPOSE.  See  the  GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   18 Oct 26   0.1   - Initial version, using the code from py-weather.py
+#                       and py-pygame-weather.py - MT
+#
+# Example:
+#
+#   import startup # Starts timing the imports if '--debug' is specified
+#   ...
+#   sys.stderr.write (startup.modules.report())
+#
+VERSION = "0.1"
+
+import sys, time, builtins, threading
+
+
+class imports(object): # Measures how long it takes to import each module (like 'python -X importtime')
+
+  def __init__(self):
+    self.modules = [] # Depth, name, time (excluding other modules imported) and total time for each module
+    self.stacks = {} # Time spent importing other modules for each thread
+    self.original = builtins.__import__
+
+  def start(self):
+    builtins.__import__ = self.load
+
+  def load(self, _name, *_args, **_kwargs):
+    if _name in sys.modules: # Already imported
+      return self.original(_name, *_args, **_kwargs)
+    _stack = self.stacks.setdefault(threading.get_ident(), [])
+    _stack.append(0)
+    _start = time.perf_counter()
+    try:
+      return self.original(_name, *_args, **_kwargs)
+    finally:
+      _time = time.perf_counter() - _start
+      _others = _stack.pop()
+      if _stack:
+        _stack[-1] += _time
+      self.modules.append((len(_stack), _name, _time - _others, _time))
+
+  def report(self): # Same format as 'python -X importtime'
+    _output = ['import time: self [us] | cumulative | imported package\n']
+    for (_depth, _name, _self, _total) in self.modules:
+      _output.append('import time: %9d | %10d | %s%s\n' % (_self * 1e6, _total * 1e6, '  ' * _depth, _name))
+    return ''.join(_output)
+
+modules = imports()
+if '--debug' in sys.argv[1:]: # Has to start before anything else is imported
+  modules.start()